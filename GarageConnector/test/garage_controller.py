@@ -35,16 +35,6 @@ class GarageController(threading.Thread):
   def temperature(self):
     return self._temperature
 
-  @classmethod
-  def fletcher16(cls, data):
-    # print(data)
-    sum1 = int(0)
-    sum2 = int(0)
-    for byte in data:
-      sum1 = (sum1 + byte) % 255
-      sum2 = (sum2 + sum1) % 255
-    return (sum2 << 8) | sum1
-
   def getCircuitPlaygroundData(self):
     return (self._state, self._temperature)
 
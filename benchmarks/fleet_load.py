@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+Fleet load test for the monitor pipeline. Simulated controller and
+connector pairs, each under its own thing name, run across worker
+processes and report to one monitor per site through a local broker
+stand-in. The fleet is grown stage by stage until end-to-end latency or
+backlog drain time exceeds the budget. Both rates are per second of the
+run: offered/s counts the reports published and deliv/s the reports the
+monitors received before the run ended; the rest is the drain.
+
+  python benchmarks/fleet_load.py --sites 100,400,1600 --speedup 600
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from garage.fleet import FleetSimulator
+
+def saturated(summary, budget):
+  return summary['latency_p99'] > budget or summary['drain_time'] > budget or\
+         summary['shard_overruns'] > 0.1
+
+def main():
+  parser = argparse.ArgumentParser(description='Load test the monitor with a simulated fleet')
+  parser.add_argument('--sites', default='50,200,800',
+                      help='comma-separated fleet sizes to run in turn')
+  parser.add_argument('--shards', type=int, default=None,
+                      help='worker processes (default: one per CPU)')
+  parser.add_argument('--speedup', type=float, default=60.0,
+                      help='simulated seconds per real second for door schedules and heartbeats')
+  parser.add_argument('--duration', type=float, default=30.0,
+                      help='real seconds to run each fleet size')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--latency-budget', type=float, default=1.0,
+                      help='p99 latency and drain time (seconds) above which the monitor is saturated')
+  parser.add_argument('--keep-going', action='store_true',
+                      help='run every fleet size even after saturation')
+  parser.add_argument('--json', metavar='PATH', help='also write the results to a JSON file')
+  args = parser.parse_args()
+
+  logging.disable(logging.WARNING)
+
+  results = []
+  saturation_point = None
+  print('{:>6} {:>6} {:>9} {:>9} {:>8} {:>8} {:>8} {:>8} {:>7} {:>7}'.format(
+    'Sites', 'Shards', 'offered/s', 'deliv/s', 'p50 ms', 'p99 ms', 'max ms', 'drain s',
+    'backlog', 'closes'))
+  for site_count in [int(sites) for sites in args.sites.split(',')]:
+    summary = FleetSimulator(site_count, args.shards, args.speedup, args.duration,
+                             args.seed).run()
+    summary['saturated'] = saturated(summary, args.latency_budget)
+    results.append(summary)
+    print('{:>6} {:>6} {:>9.1f} {:>9.1f} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f} {:>7} {:>7}{}'.format(
+      summary['sites'], summary['shards'], summary['offered_rate'], summary['delivered_rate'],
+      summary['latency_p50']*1000, summary['latency_p99']*1000, summary['latency_max']*1000,
+      summary['drain_time'], summary['max_backlog'], summary['auto_closes'],
+      '  SATURATED' if summary['saturated'] else ''))
+    if summary['saturated'] and saturation_point is None:
+      saturation_point = site_count
+      if not args.keep_going:
+        break
+
+  if saturation_point is None:
+    print('No saturation up to {} sites'.format(results[-1]['sites']))
+  else:
+    print('Saturated at {} sites'.format(saturation_point))
+
+  if args.json:
+    with open(args.json, 'w') as results_file:
+      json.dump(results, results_file, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+'''
+Ingest benchmark for GarageMonitor. Synthetic shadow streams are fed
+through updateCallback with email delivery, HTTP and (by default) disk
+side effects stubbed out, and throughput, callback latency and memory
+growth are compared against the stored baselines in baselines.json.
+
+The event database starts with --preload-years of daily open/close cycles,
+as a long-running monitor's would. Callback latency is also reported per
+slice of the run, against the event database and history size reached, so
+growth in either shows up as a rising p99.
+
+  python benchmarks/monitor_ingest.py                        # compare to baselines
+  python benchmarks/monitor_ingest.py --file-db --count 2000 # the /file baselines
+  python benchmarks/monitor_ingest.py --save-baseline        # record new baselines
+'''
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tinydb import TinyDB
+from tinydb.storages import MemoryStorage
+
+from garage.deadlines import DeadlineScheduler
+from garage.publishing import PublishScheduler
+from garage.replay import ReplayMessage, ReplayMonitor
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+UPDATE_TOPIC = '$aws/things/GarageDoor/shadow/update/accepted'
+HEARTBEAT = 600
+START_TIME = 1546300800  # 2019-01-01 00:00:00 UTC
+YEAR = 365*24*60*60
+BUCKETS = 5
+
+class ShadowStream(object):
+  '''Builds accepted-update payloads with increasing versions.'''
+  def __init__(self, start_time=START_TIME):
+    self.version = 0
+    self.time = start_time
+
+  def message(self, main, side, state_update):
+    self.version += 1
+    payload = {
+      'state': {'reported': {
+        'State': main,
+        'SideDoorState': side,
+        'StateUpdate': state_update,
+        'Temperature': 21.5,
+        'NETGEAR63': 40,
+        'Omega-11A3': 80,
+        'Timestamp': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.time))}},
+      'version': self.version,
+      'timestamp': self.time}
+    return (self.time, ReplayMessage(UPDATE_TOPIC, json.dumps(payload).encode('utf-8')))
+
+def steadyHeartbeats(count):
+  stream = ShadowStream()
+  for _ in range(count):
+    stream.time += HEARTBEAT
+    yield stream.message('Closed', 'Closed', False)
+
+def longOpen(count):
+  stream = ShadowStream()
+  yield stream.message('FullyOpen', 'Closed', True)
+  for _ in range(count - 1):
+    stream.time += HEARTBEAT
+    yield stream.message('FullyOpen', 'Closed', False)
+
+def flapping(count):
+  stream = ShadowStream()
+  for index in range(count):
+    stream.time += 2
+    yield stream.message('Closed', 'Open' if index % 2 == 0 else 'Closed', True)
+
+def multiYear(count, start_time=START_TIME):
+  '''
+  Daily open/close cycles, count messages in total. Heartbeats back off
+  while closed as PublishScheduler's do, so a day is about 30 messages and
+  the default count covers close to two years.
+  '''
+  stream = ShadowStream(start_time)
+  produced = 0
+  while produced < count:
+    for main, duration in (('Open', 15), ('FullyOpen', 1800), ('Open', 15), ('Closed', 84570)):
+      if produced >= count:
+        return
+      stream.time += 1
+      yield stream.message(main, 'Closed', True)
+      produced += 1
+      interval = PublishScheduler.MIN_HEARTBEAT
+      elapsed = 0
+      while elapsed + interval < duration and produced < count:
+        stream.time += interval
+        elapsed += interval
+        yield stream.message(main, 'Closed', False)
+        produced += 1
+        if main == 'Closed':
+          interval = min(PublishScheduler.MAX_HEARTBEAT, interval*2)
+      stream.time += duration - elapsed
+
+def preloadRecords(years):
+  '''Event records for the given years of daily cycles, as handleEvent writes them.'''
+  records = []
+  for timestamp, message in multiYear(sys.maxsize, START_TIME - years*YEAR):
+    if timestamp >= START_TIME:
+      break
+    shadow = json.loads(message.payload)
+    record = shadow['state']['reported']
+    record['version'] = shadow['version']
+    record['timestamp'] = shadow['timestamp']
+    records.append(record)
+  return records
+
+# Scenario generators and their default message counts. A door left open
+# emails its whole history on every heartbeat, so long_open runs for one
+# week of heartbeats rather than the full count.
+SCENARIOS = {
+  'steady_heartbeats': (steadyHeartbeats, 20000),
+  'long_open': (longOpen, 7*24*60*60//HEARTBEAT),
+  'flapping': (flapping, 20000),
+  'multi_year': (multiYear, 20000),
+}
+
+def percentile(values, fraction):
+  index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+  return values[index]
+
+def createMonitor(file_db, now, preload):
+  deadlines = DeadlineScheduler(clock=lambda: now[0])
+  db_path = None
+  if file_db:
+    db_path = tempfile.mktemp(suffix='.json')
+    db = TinyDB(db_path)
+  else:
+    db = TinyDB(storage=MemoryStorage)
+  if len(preload) > 0:
+    db.insert_multiple(preload)
+  return (ReplayMonitor(db=db, deadlines=deadlines), db_path)
+
+def drive(monitor, messages, now, latencies=None, history_sizes=None):
+  for timestamp, message in messages:
+    now[0] = timestamp
+    monitor.deadlines.runDue()
+    callback_start = time.perf_counter()
+    monitor.updateCallback(None, None, message)
+    if latencies is not None:
+      latencies.append(time.perf_counter() - callback_start)
+      history_sizes.append(len(monitor.history))
+
+def bucketLatencies(latencies, history_sizes, preloaded):
+  '''
+  Splits the run into BUCKETS consecutive slices. For each slice, reports
+  the event records written by its end, the largest history and the
+  callback latency percentiles.
+  '''
+  buckets = []
+  size = max(1, -(-len(latencies)//BUCKETS))
+  for start in range(0, len(latencies), size):
+    end = min(len(latencies), start + size)
+    bucket = sorted(latencies[start:end])
+    buckets.append({
+      'db_records': preloaded + end,
+      'max_history': max(history_sizes[start:end]),
+      'p50_latency_ms': percentile(bucket, 0.50) * 1000,
+      'p99_latency_ms': percentile(bucket, 0.99) * 1000,
+    })
+  return buckets
+
+def runScenario(name, count, file_db, preload):
+  generator, default_count = SCENARIOS[name]
+  messages = list(generator(count or default_count))
+
+  # Timing pass.
+  now = [START_TIME]
+  monitor, db_path = createMonitor(file_db, now, preload)
+  latencies = []
+  history_sizes = []
+  start_time = time.perf_counter()
+  drive(monitor, messages, now, latencies, history_sizes)
+  elapsed = time.perf_counter() - start_time
+  flush_start = time.perf_counter()
+  monitor.close()
+  flush_time = time.perf_counter() - flush_start
+  writer_stats = monitor.writer.stats
+  if db_path is not None:
+    os.remove(db_path)
+
+  # Memory pass; tracemalloc would distort the timings above.
+  now = [START_TIME]
+  memory_monitor, db_path = createMonitor(file_db, now, preload)
+  # Email bodies are garbage once sent and formatting them under
+  # tracemalloc is slow, so only the timing pass pays for them.
+  memory_monitor.sendEmail = lambda shadow, init=False: memory_monitor.deliverEmail(None)
+  tracemalloc.start()
+  start_memory = tracemalloc.get_traced_memory()[0]
+  drive(memory_monitor, messages, now)
+  memory_monitor.close()
+  memory_growth = tracemalloc.get_traced_memory()[0] - start_memory
+  tracemalloc.stop()
+  if db_path is not None:
+    os.remove(db_path)
+
+  buckets = bucketLatencies(latencies, history_sizes, len(preload))
+  latencies.sort()
+  return {
+    'messages': len(messages),
+    'preloaded_records': len(preload),
+    'messages_per_second': len(messages) / elapsed,
+    'p50_latency_ms': percentile(latencies, 0.50) * 1000,
+    'p99_latency_ms': percentile(latencies, 0.99) * 1000,
+    'memory_growth_kb': memory_growth / 1024.0,
+    'flush_time_s': flush_time,
+    'blocked_puts': writer_stats['blocked_puts'],
+    'dropped_records': writer_stats['dropped_records'],
+    'emails': monitor.email_count,
+    'auto_closes': monitor.activation_count,
+    'buckets': buckets,
+  }
+
+def baselineKey(name, result, file_db):
+  return '{}/{}{}'.format(name, result['messages'], '/file' if file_db else '')
+
+def compare(name, result, baseline, tolerance):
+  '''Returns a list of regressions of result against baseline.'''
+  regressions = []
+  if result['messages_per_second'] < baseline['messages_per_second'] * (1 - tolerance):
+    regressions.append('{}: {:.0f} msg/s is below the baseline {:.0f}'.format(
+      name, result['messages_per_second'], baseline['messages_per_second']))
+  # Sub-millisecond tail latencies are noisy, so allow some absolute slack.
+  if result['p99_latency_ms'] > baseline['p99_latency_ms'] * (1 + tolerance) + 0.25:
+    regressions.append('{}: p99 {:.3f} ms is above the baseline {:.3f}'.format(
+      name, result['p99_latency_ms'], baseline['p99_latency_ms']))
+  if 'buckets' in baseline:
+    last, baseline_last = result['buckets'][-1], baseline['buckets'][-1]
+    if last['p99_latency_ms'] > baseline_last['p99_latency_ms'] * (1 + tolerance) + 0.25:
+      regressions.append('{}: p99 {:.3f} ms at {} records is above the baseline {:.3f}'.format(
+        name, last['p99_latency_ms'], last['db_records'], baseline_last['p99_latency_ms']))
+  if result['memory_growth_kb'] > baseline['memory_growth_kb'] * (1 + tolerance) + 64:
+    regressions.append('{}: memory grew {:.0f} kB, baseline {:.0f}'.format(
+      name, result['memory_growth_kb'], baseline['memory_growth_kb']))
+  for key in ('emails', 'auto_closes'):
+    if result[key] != baseline[key]:
+      regressions.append('{}: {} {} differs from the baseline {}'.format(
+        name, result[key], key, baseline[key]))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark GarageMonitor ingest')
+  parser.add_argument('scenarios', nargs='*', default=sorted(SCENARIOS.keys()))
+  parser.add_argument('--count', type=int, default=None,
+                      help='messages per scenario (default: per scenario)')
+  parser.add_argument('--file-db', action='store_true',
+                      help='write events to a TinyDB file instead of memory')
+  parser.add_argument('--preload-years', type=float, default=3.0,
+                      help='years of daily cycles in the event database before the run')
+  parser.add_argument('--tolerance', type=float, default=0.5,
+                      help='allowed relative regression before failing')
+  parser.add_argument('--save-baseline', action='store_true')
+  args = parser.parse_args()
+
+  # Dropped records are counted in the results.
+  logging.disable(logging.ERROR)
+
+  baselines = {}
+  if os.path.exists(BASELINE_PATH):
+    with open(BASELINE_PATH) as baseline_file:
+      baselines = json.load(baseline_file)
+
+  preload = preloadRecords(args.preload_years)
+  preloaded = baselines.get('preloaded_records', 0)
+  if preloaded != len(preload):
+    print('Baselines were recorded with {} preloaded records, not {}; not comparing'.format(
+      preloaded, len(preload)))
+    baselines['scenarios'] = {}
+
+  results = {}
+  regressions = []
+  print('{:18} {:>8} {:>10} {:>9} {:>9} {:>10} {:>8} {:>8}'.format(
+    'Scenario', 'Messages', 'msg/s', 'p50 ms', 'p99 ms', 'mem kB', 'flush s', 'dropped'))
+  for name in args.scenarios:
+    result = runScenario(name, args.count, args.file_db, preload)
+    results[name] = result
+    print('{:18} {:>8} {:>10.0f} {:>9.3f} {:>9.3f} {:>10.0f} {:>8.3f} {:>8}'.format(
+      name, result['messages'], result['messages_per_second'], result['p50_latency_ms'],
+      result['p99_latency_ms'], result['memory_growth_kb'], result['flush_time_s'],
+      result['dropped_records']))
+    key = baselineKey(name, result, args.file_db)
+    if key in baselines.get('scenarios', {}):
+      regressions.extend(compare(name, result, baselines['scenarios'][key], args.tolerance))
+
+  print()
+  print('{:18} {:>10} {:>8} {:>9} {:>9}'.format(
+    'Scenario', 'DB records', 'history', 'p50 ms', 'p99 ms'))
+  for name in args.scenarios:
+    for bucket in results[name]['buckets']:
+      print('{:18} {:>10} {:>8} {:>9.3f} {:>9.3f}'.format(
+        name, bucket['db_records'], bucket['max_history'], bucket['p50_latency_ms'],
+        bucket['p99_latency_ms']))
+
+  if args.save_baseline:
+    baselines['machine'] = '{} {} Python {}'.format(
+      platform.system(), platform.machine(), platform.python_version())
+    baselines['preloaded_records'] = len(preload)
+    scenarios = baselines.setdefault('scenarios', {})
+    for name, result in results.items():
+      scenarios[baselineKey(name, result, args.file_db)] = result
+    with open(BASELINE_PATH, 'w') as baseline_file:
+      json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+    print('Saved baselines to {}'.format(BASELINE_PATH))
+    return
+
+  for regression in regressions:
+    print('REGRESSION: {}'.format(regression))
+  sys.exit(1 if len(regressions) > 0 else 0)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,104 @@
+import atexit
+import heapq
+import logging
+import struct
+import threading
+import time
+
+logging.basicConfig(format='%(asctime)-15s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# A capture file is MAGIC followed by records of a RECORD_FORMAT header
+# (capture time, record kind, payload length) and the raw payload.
+MAGIC = b'GDCAP1\n'
+RECORD_FORMAT = '<dBH'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+CPX_FRAME = 1  # payload: the raw 7-byte frame read from the CPX
+GPIO_EDGE = 2  # payload: b'\x01' side door opened, b'\x00' closed
+SHADOW = 3     # payload: topic, a newline, then the MQTT message payload
+
+KIND_NAMES = {CPX_FRAME: 'cpx', GPIO_EDGE: 'gpio', SHADOW: 'shadow'}
+
+class CaptureWriter(object):
+  '''
+  Appends records to a capture file. A background thread flushes new
+  records every FLUSH_INTERVAL seconds, so a quiet period does not hold
+  back the last records, and the file is closed at interpreter exit.
+  '''
+  FLUSH_INTERVAL = 5.0
+
+  def __init__(self, path):
+    self._lock = threading.Lock()
+    self._file = open(path, 'ab')
+    if self._file.tell() == 0:
+      self._file.write(MAGIC)
+    self._dirty = False
+    self._closed = threading.Event()
+    self.record_count = 0
+    self._flusher = threading.Thread(target=self._flushLoop)
+    self._flusher.daemon = True
+    self._flusher.start()
+    atexit.register(self.close)
+
+  def record(self, kind, payload, timestamp=None):
+    if timestamp is None:
+      timestamp = time.time()
+    header = struct.pack(RECORD_FORMAT, timestamp, kind, len(payload))
+    with self._lock:
+      self._file.write(header)
+      self._file.write(payload)
+      self.record_count += 1
+      self._dirty = True
+
+  def recordFrame(self, frame):
+    self.record(CPX_FRAME, bytes(bytearray(frame)))
+
+  def recordGpio(self, state):
+    self.record(GPIO_EDGE, b'\x01' if state == 'Open' else b'\x00')
+
+  def recordShadow(self, topic, payload):
+    if not isinstance(payload, bytes):
+      payload = payload.encode('utf-8')
+    self.record(SHADOW, topic.encode('utf-8') + b'\n' + payload)
+
+  def _flushLoop(self):
+    while not self._closed.wait(CaptureWriter.FLUSH_INTERVAL):
+      if self._dirty:
+        self.flush()
+
+  def flush(self):
+    with self._lock:
+      if not self._file.closed:
+        self._file.flush()
+        self._dirty = False
+
+  def close(self):
+    self._closed.set()
+    with self._lock:
+      self._file.close()
+
+def readCapture(path):
+  '''Yields (timestamp, kind, payload) for each record in a capture file.'''
+  with open(path, 'rb') as capture_file:
+    if capture_file.read(len(MAGIC)) != MAGIC:
+      raise ValueError('{} is not a capture file'.format(path))
+    while True:
+      header = capture_file.read(RECORD_SIZE)
+      if len(header) < RECORD_SIZE:
+        break
+      timestamp, kind, length = struct.unpack(RECORD_FORMAT, header)
+      payload = capture_file.read(length)
+      if len(payload) < length:
+        logger.warning('Truncated record at the end of {}'.format(path))
+        break
+      yield (timestamp, kind, payload)
+
+def mergeCaptures(paths):
+  '''Merges the records of several capture files in timestamp order.'''
+  return heapq.merge(*[readCapture(path) for path in paths], key=lambda record: record[0])
+
+def splitShadow(payload):
+  topic, message = payload.split(b'\n', 1)
+  return (topic.decode('utf-8'), message)
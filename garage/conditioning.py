@@ -0,0 +1,98 @@
+class StateDebouncer(object):
+  '''
+  Accepts a new CPX state code only once it has been read WINDOW times in a
+  row, so a single corrupt frame that passes the checksum cannot flip the
+  door state or the activation bit.
+  '''
+  WINDOW = 3
+
+  def __init__(self, window=WINDOW):
+    self._window = window
+    self._candidate = None
+    self._count = 0
+    self.state = None
+    self.suppressed = 0
+
+  def update(self, state):
+    if state == self._candidate:
+      self._count += 1
+    else:
+      self._candidate = state
+      self._count = 1
+
+    if self.state is None or self._count >= self._window:
+      self.state = state
+    elif state != self.state:
+      self.suppressed += 1
+    return self.state
+
+class TemperatureFilter(object):
+  '''
+  Exponentially weighted moving average of the CPX temperature. Readings
+  outside the sensor's range are dropped; readings more than MAX_STEP from
+  the average are treated as outliers unless MAX_OUTLIERS of them arrive in
+  a row, in which case the filter restarts from the new value.
+  '''
+  ALPHA = 0.2
+  MAX_STEP = 3.0
+  MAX_OUTLIERS = 10
+  MIN_TEMPERATURE = -40.0
+  MAX_TEMPERATURE = 85.0
+
+  def __init__(self, alpha=ALPHA, max_step=MAX_STEP, max_outliers=MAX_OUTLIERS):
+    self._alpha = alpha
+    self._max_step = max_step
+    self._max_outliers = max_outliers
+    self._outliers = 0
+    self._value = None
+    self.rejected = 0
+
+  @property
+  def value(self):
+    if self._value is None:
+      return None
+    return round(self._value, 2)
+
+  def update(self, temperature):
+    if temperature < TemperatureFilter.MIN_TEMPERATURE or\
+       temperature > TemperatureFilter.MAX_TEMPERATURE:
+      self.rejected += 1
+      return self.value
+
+    if self._value is None:
+      self._value = temperature
+    elif abs(temperature - self._value) > self._max_step:
+      self._outliers += 1
+      if self._outliers < self._max_outliers:
+        self.rejected += 1
+        return self.value
+      self._value = temperature
+    self._outliers = 0
+    self._value += self._alpha*(temperature - self._value)
+    return self.value
+
+class SensorConditioner(object):
+  '''
+  Conditioning stage between the CPX and GarageController. Any object with
+  a condition(state, temperature) method returning the conditioned pair
+  (temperature may be None until a valid reading arrives) and a stats
+  property can be passed to GarageController in its place.
+  '''
+  def __init__(self, debouncer=None, temperature_filter=None):
+    if debouncer is None:
+      debouncer = StateDebouncer()
+    if temperature_filter is None:
+      temperature_filter = TemperatureFilter()
+    self._debouncer = debouncer
+    self._temperature_filter = temperature_filter
+
+  def condition(self, state, temperature):
+    return (self._debouncer.update(state),
+            self._temperature_filter.update(temperature))
+
+  @property
+  def stats(self):
+    return {
+      'suppressed_states': self._debouncer.suppressed,
+      'rejected_temperatures': self._temperature_filter.rejected
+    }
@@ -7,32 +7,81 @@ import time
 
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 from garage.omega import getSideDoorState, getSignalStrengths
+from garage.publishing import PublishScheduler
+from garage.transport import activateTopic, stateTopic
 
 logging.basicConfig(format='%(asctime)-15s %(message)s')
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+class HTTPControllerSource(object):
+  '''Reads the controller over its HTTP API, reusing one keep-alive connection.'''
+  def __init__(self, url='http://localhost:5000'):
+    self._url = url
+    self._session = requests.Session()
+
+  def read(self):
+    return self._session.get('{}/json/'.format(self._url)).json()
+
+  def activate(self):
+    self._session.put('{}/activate/'.format(self._url))
+
+class LocalControllerSource(object):
+  '''Reads a GarageController running in the same process.'''
+  def __init__(self, controller):
+    self._controller = controller
+
+  def read(self):
+    return {'state': self._controller.state,
+            'temperature': self._controller.temperature}
+
+  def activate(self):
+    self._controller.remotely_activated = True
+
 class GarageConnector(object):
-  def __init__(self):
+  KEEPALIVE = 60
+  AWS_RETRY_INTERVAL = 10
+
+  def __init__(self, recorder=None, scheduler=None, local_transport=None,
+               source=None, thing_name='GarageDoor', side_door=getSideDoorState):
+    if scheduler is None:
+      scheduler = PublishScheduler()
+    if source is None:
+      source = HTTPControllerSource()
+    self._source = source
+    self._getSideDoorState = side_door
+    self.thing_name = thing_name
+    self.shadow_topic = '$aws/things/{}/shadow'.format(thing_name)
+    self.status_topic = '{}/connector/status'.format(thing_name)
     self._iot = None
+    self._local = local_transport
+    self._scheduler = scheduler
+    self._last_side_door_state = ''
+    self.recorder = recorder
     self._connected = False
+    # Key of the state AWS last received; it can fall behind the LAN while
+    # the uplink is down.
+    self._aws_key = None
+    self._aws_retry_time = 0.0
     self.running = False
     self.status = ''
     self.remotely_activated = False
 
-  def onlineCallback(self, client):
+  def onlineCallback(self):
     logger.warn('Connected to AWS IoT')
     self._connected = True
 
-  def offlineCallback(self, client):
+  def offlineCallback(self):
     logger.warn('NOT Connected to AWS IoT')
     self._connected = False
 
   def updateCallback(self, client, userdata, message):
     topic = message.topic
+    if self.recorder is not None:
+      self.recorder.recordShadow(topic, message.payload)
     logger.info(topic)
-    logger.info(message.payload)
+    logger.debug(message.payload)
     if topic.endswith('delta'):
       shadowData = json.loads(message.payload)
       #state = shadowData['state']['delta']['State']
@@ -46,34 +95,113 @@ class GarageConnector(object):
       self.status = 'rejected'
     else:
       self.status = 'invalid response: {}'.format(topic)
-    logger.debug('Request Status: {}'.format(self.status))
+    logger.debug('Request Status: %s', self.status)
+
+  @staticmethod
+  def reportedState(state, state_changed):
+    return {
+      "State": "{}".format(state['main']),
+      "StateUpdate": state_changed,
+      "Temperature": state['temperature'],
+      "SideDoorState": state['side'],
+      "Timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 
   def update(self, state, state_changed=False):
+    reported = GarageConnector.reportedState(state, state_changed)
+    published = False
+
+    # The LAN copy goes out first; it skips the slow Wi-Fi scan.
+    if self._local is not None:
+      try:
+        self._local.publish(stateTopic(self.thing_name), json.dumps(
+          {"state": {"reported": reported}, "timestamp": time.time()}), 1)
+        published = True
+      except Exception as e:
+        logger.debug(e)
+
+    if self._iot is None or not self._connected:
+      return published
+    return self.updateAWS(state, reported, state_changed) or published
+
+  def updateAWS(self, state, reported, state_changed):
+    '''Publishes a report to the AWS shadow. Returns True on success.'''
     try:
       signal_strengths = getSignalStrengths()
-      logger.debug('Signal Strengths:\n{}'.format(signal_strengths))
+      logger.debug('Signal Strengths:\n%s', signal_strengths)
 
       if state_changed:
-        self._iot.publish("$aws/things/GarageDoor/shadow/delete", "", 1)
-
-      payload = {"state": {"reported": {
-        "State": "{}".format(state['main']),
-        "StateUpdate": state_changed,
-        "Temperature": state['temperature'],
-        "SideDoorState": state['side'],
-        "NETGEAR63": signal_strengths['NETGEAR63'],
-        "Omega-11A3": signal_strengths['Omega-11A3'],
-        "Timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}}}
+        self._iot.publish(self.shadow_topic + "/delete", "", 1)
+
+      reported["NETGEAR63"] = signal_strengths['NETGEAR63']
+      reported["Omega-11A3"] = signal_strengths['Omega-11A3']
+      payload = {"state": {"reported": reported}}
       logger.debug('Publishing shadow update...')
-      self._iot.publish("$aws/things/GarageDoor/shadow/update",
-                        json.dumps(payload), 1)
+      self._iot.publish(self.shadow_topic + "/update", json.dumps(payload), 1)
       logger.debug('Published shadow update...')
     except Exception as e:
       logger.debug(e)
+      self._aws_retry_time = time.time() + GarageConnector.AWS_RETRY_INTERVAL
+      return False
+    self._aws_key = PublishScheduler.stateKey(state)
+    return True
+
+  def localActivateCallback(self, client, userdata, message):
+    logger.info('Activation requested over the LAN')
+    self.remotely_activated = True
 
   def stop(self):
     self.running = False
 
+  @property
+  def stats(self):
+    return self._scheduler.stats
+
+  def poll(self):
+    '''One pass of the connector loop. Returns False if the controller could not be read.'''
+    if self.remotely_activated:
+      logger.debug('Requesting activation...')
+      self._source.activate()
+      self.remotely_activated = False
+
+    try:
+      data = self._source.read()
+      logger.debug('Controller Data: %s', data)
+    except Exception as e:
+      logger.debug(e)
+      return False
+
+    side_door_state = self._getSideDoorState()
+    logger.debug('Side Door State: %s', side_door_state)
+    if self.recorder is not None and side_door_state != self._last_side_door_state:
+      self.recorder.recordGpio(side_door_state)
+    self._last_side_door_state = side_door_state
+
+    full_state = {
+      "main": data['state'],
+      "temperature": data['temperature'],
+      "side": side_door_state
+    }
+
+    kind = self._scheduler.due(full_state)
+    if kind == PublishScheduler.CHANGE:
+      logger.debug('State changed. Updating shadow...')
+    elif kind == PublishScheduler.HEARTBEAT:
+      logger.debug('Heartbeat due. Updating shadow...')
+    if kind is not None:
+      if self.update(full_state, kind == PublishScheduler.CHANGE):
+        self._scheduler.published(full_state, kind)
+    elif self.awsBehind(full_state):
+      # The change went out on the LAN only; send it now that AWS is back.
+      logger.debug('Resending the last change to AWS...')
+      self.updateAWS(full_state, GarageConnector.reportedState(full_state, True), True)
+    return True
+
+  def awsBehind(self, state):
+    key = PublishScheduler.stateKey(state)
+    return self._iot is not None and self._connected and\
+           key == self._scheduler.published_key and key != self._aws_key and\
+           time.time() >= self._aws_retry_time
+
   def run(self):
     aws_host = "a1qhgyhvs274m3.iot.us-east-2.amazonaws.com"
     aws_port = 8883
@@ -85,77 +213,69 @@ class GarageConnector(object):
     self._iot = AWSIoTMQTTClient("GarageConnector")
     self._iot.configureEndpoint("a1qhgyhvs274m3.iot.us-east-2.amazonaws.com", 8883)
     self._iot.configureCredentials(caPath, keyPath, certPath)
- 
-    start_time = time.time()
-    state = ''
-    last_main_door_state = ''
-    last_side_door_state = ''
-    data = None
- 
-    logger.debug('Starting shadow connector main outer loop...')
+    # The broker announces our disappearance, so shadow heartbeats do not
+    # have to double as a liveness signal.
+    self._iot.configureLastWill(self.status_topic,
+                                json.dumps({"Connected": False}), 1)
+    self._iot.onOnline = self.onlineCallback
+    self._iot.onOffline = self.offlineCallback
+
+    if self._local is not None:
+      self.connectLocal()
+
+    logger.debug('Starting shadow connector main loop...')
     self.running = True
+    aws_connected = False
+    next_connect_time = 0.0
     while self.running:
-      try:
-        logger.info('Connecting to AWS...')
-        self._iot.connect()
-
-        logger.info('Subscribing for Shadow Updates...')
-        self._iot.subscribe("$aws/things/GarageDoor/shadow/update/accepted", 1,
-                            self.updateCallback)
-        self._iot.subscribe("$aws/things/GarageDoor/shadow/update/rejected", 1,
-                            self.updateCallback)
-        self._iot.subscribe("$aws/things/GarageDoor/shadow/update/delta", 1,
-                            self.updateCallback)
-        logger.info('Subscribed for Shadow Updates.')
-
-        logger.debug('Starting shadow connector main inner loop...')
-        while self.running:
-          if self.remotely_activated:
-            logger.debug('Requesting activation...')
-            requests.put('http://localhost:5000/activate/')
-            self.remotely_activated = False
-
+      if not aws_connected and time.time() >= next_connect_time:
+        try:
+          self.connectAWS()
+          aws_connected = True
+          self._connected = True
+        except Exception as e:
+          logger.debug(e)
+          self._connected = False
           try:
-            response = requests.get('http://localhost:5000/json/')
-            data = response.json()
-            logger.debug('Controller Data: {}'.format(data))
-          except Exception as e:
-            logger.debug(e)
-            time.sleep(5)
+            self._iot.disconnect()
+          except:
+            pass
+          next_connect_time = time.time() + GarageConnector.AWS_RETRY_INTERVAL
+          if self._local is None:
+            logger.debug('Sleeping for 10 seconds before attempting to reconnect to AWS...')
+            time.sleep(10)
             continue
+          # Keep serving the LAN while the uplink is down.
+          logger.debug('Retrying AWS in 10 seconds; continuing on the LAN...')
 
-          side_door_state = getSideDoorState()
-          logger.debug('Side Door State: {}'.format(side_door_state))
-
-          full_state = {
-            "main": data['state'],
-            "temperature": data['temperature'],
-            "side": side_door_state
-          }
-
-          duration = time.time() - start_time
-
-          if last_main_door_state != data['state'] or\
-             last_side_door_state != side_door_state:
-            logger.debug('State changed. Updating shadow...')
-            self.update(full_state, True)
-            start_time = time.time()
-          elif duration > 600:
-            logger.debug('Timer lapsed. Updating shadow...')
-            self.update(full_state)
-            start_time = time.time()
-
-          last_main_door_state = data['state']
-          last_side_door_state = side_door_state
-          time.sleep(1)
+      try:
+        if not self.poll():
+          time.sleep(5)
+          continue
       except Exception as e:
         logger.debug(e)
-        try:
-          self._iot.disconnect()
-        except:
-          pass
-        logger.debug('Sleeping for 10 seconds before attempting to reconnect to AWS...')
-        time.sleep(10)
+        time.sleep(5)
+        continue
+      time.sleep(1)
+
+  def connectLocal(self):
+    logger.info('Connecting to the local broker...')
+    try:
+      self._local.connect()
+      self._local.subscribe(activateTopic(self.thing_name), 1, self.localActivateCallback)
+    except Exception as e:
+      logger.error('Failed to connect to the local broker: {}'.format(e))
+
+  def connectAWS(self):
+    logger.info('Connecting to AWS...')
+    self._iot.connect(keepAliveIntervalSecond=GarageConnector.KEEPALIVE)
+    self._iot.publish(self.status_topic, json.dumps({"Connected": True}), 1)
+
+    logger.info('Subscribing for Shadow Updates...')
+    self._iot.subscribe(self.shadow_topic + "/update/accepted", 1, self.updateCallback)
+    self._iot.subscribe(self.shadow_topic + "/update/rejected", 1, self.updateCallback)
+    self._iot.subscribe(self.shadow_topic + "/update/delta", 1, self.updateCallback)
+    logger.info('Subscribed for Shadow Updates.')
 
 if __name__ == '__main__':
   logger = logging.getLogger(__name__)
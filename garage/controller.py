@@ -1,89 +1,229 @@
 import logging
-import os
 import threading
 import time
 
+from garage.conditioning import SensorConditioner
 from garage.cpx import CircuitPlaygroundExpress
-from garage.omega import getSideDoorState
+from garage.omega import getSideDoorState, setRelay
+from garage.recovery import RecoveryPolicy
 
 logging.basicConfig(format='%(asctime)-15s %(message)s')
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+class PollScheduler(object):
+  '''
+  Chooses how long the controller sleeps between CPX samples. Sampling is
+  fast while the door is moving or an activation is in progress and backs
+  off once the door has rested in Closed or FullyOpen for a while. wake()
+  cuts the current sleep short and restores the fast rate.
+  '''
+  FAST_INTERVAL = 0.1
+  SLOW_INTERVAL = 0.25  # bounds the wait for a proximity activation at the CPX
+  SETTLE_SAMPLES = 20
+  STABLE_STATES = (2, 8)  # Closed, FullyOpen
+
+  def __init__(self, fast_interval=FAST_INTERVAL, slow_interval=SLOW_INTERVAL,
+               settle_samples=SETTLE_SAMPLES):
+    self._fast_interval = fast_interval
+    self._slow_interval = slow_interval
+    self._settle_samples = settle_samples
+    self._wakeup = threading.Event()
+    self._last_state = None
+    self._stable_samples = 0
+    self.interval = fast_interval
+    self.fast_wakeups = 0
+    self.slow_wakeups = 0
+    self.early_wakeups = 0
+
+  def update(self, state, busy=False):
+    if busy or state != self._last_state or\
+       state not in PollScheduler.STABLE_STATES:
+      self._stable_samples = 0
+      self.interval = self._fast_interval
+    else:
+      self._stable_samples += 1
+      if self._stable_samples >= self._settle_samples:
+        self.interval = self._slow_interval
+    self._last_state = state
+
+  def wake(self):
+    self._stable_samples = 0
+    self.interval = self._fast_interval
+    self._wakeup.set()
+
+  def wait(self):
+    if self.interval == self._fast_interval:
+      self.fast_wakeups += 1
+    else:
+      self.slow_wakeups += 1
+    if self._wakeup.wait(self.interval):
+      self.early_wakeups += 1
+    self._wakeup.clear()
+
+  @property
+  def stats(self):
+    return {
+      'poll_interval': self.interval,
+      'poll_rate': 1.0 / self.interval,
+      'fast_wakeups': self.fast_wakeups,
+      'slow_wakeups': self.slow_wakeups,
+      'early_wakeups': self.early_wakeups
+    }
+
 class GarageController(threading.Thread):
   STATE_NAMES = ['None', 'Activated',
                 'Closed', 'Closed/Activated',
                 'Open', 'Open/Activated', '', '',
                 'FullyOpen', 'FullyOpen/Activated']
 
-  def __init__(self):
+  def __init__(self, conditioner=None, recorder=None,
+               side_door=getSideDoorState, relay=setRelay):
     threading.Thread.__init__(self)
+    if conditioner is None:
+      conditioner = SensorConditioner()
+    self._conditioner = conditioner
+    self.recorder = recorder
+    self._getSideDoorState = side_door
+    self._setRelay = relay
     self._running = False
     self._state = 0
     self._temperature = 0.0
-    self.remotely_activated = False
+    self._sample_time = 0.0
+    self._listeners = []
+    self._remotely_activated = False
+    self._scheduler = PollScheduler()
+    self._recovery = RecoveryPolicy()
+    self._activation_count = 0
 
   @property
   def state(self):
     return GarageController.STATE_NAMES[self._state]
 
+  @property
+  def remotely_activated(self):
+    return self._remotely_activated
+
+  @remotely_activated.setter
+  def remotely_activated(self, value):
+    self._remotely_activated = value
+    if value:
+      self._scheduler.wake()
+
+  @property
+  def stats(self):
+    stats = self._scheduler.stats
+    stats.update(self._recovery.stats)
+    stats.update(self._conditioner.stats)
+    stats['activation_count'] = self._activation_count
+    return stats
+
+  @property
+  def poll_interval(self):
+    return self._scheduler.interval
+
+  @property
+  def state_code(self):
+    return self._state
+
   @property
   def temperature(self):
     return self._temperature
 
+  @property
+  def sample_time(self):
+    return self._sample_time
+
+  def addListener(self, callback):
+    '''callback(state_code, temperature, timestamp) is called from the
+    controller thread whenever the state or temperature changes.'''
+    self._listeners.append(callback)
+
+  def notifyListeners(self):
+    for callback in self._listeners:
+      try:
+        callback(self._state, self._temperature, self._sample_time)
+      except Exception as e:
+        logger.debug(e)
+
   def stop(self):
-    self._running = True
+    self._running = False
+    self._scheduler.wake()
+
+  def sample(self, cpx):
+    '''Read and act on one CPX sample. Returns False for an invalid frame.'''
+    sensor_data = cpx.getSensorData()
+    if sensor_data == None:
+      return False
+    raw_state,raw_temperature = sensor_data
+    logger.debug('CPX State: %s, temperature: %s', raw_state, raw_temperature)
+    new_state,new_temperature = self._conditioner.condition(raw_state, raw_temperature)
+
+    if (self._state & 0x01) == 0:  # not activated
+      if new_state & 0x01:         # activate
+        if new_state > 3 or self._getSideDoorState() == 'Open'\
+                or self.remotely_activated:
+          logger.debug('Turning on relay.')
+          self._setRelay(True)
+        self.remotely_activated = False
+        self._activation_count += 1
+      elif self.remotely_activated:
+        logger.info('Requesting Activation...')
+        cpx.requestActivation()
+    elif self._state & 0x01:       # activated
+      self.remotely_activated = False
+      if (new_state & 0x01) == 0:  # deactivate
+        logger.debug('Turning off relay.')
+        self._setRelay(False)
+      else:
+        # request deactivation
+        logger.info('Requesting Deactivation...')
+        cpx.requestDeactivation()
+
+    last_state = self._state
+    last_temperature = self._temperature
+    self._state = new_state
+
+    if new_temperature is not None:
+      self._temperature = new_temperature
+
+    self._sample_time = time.time()
+    if self._state != last_state or self._temperature != last_temperature:
+      self.notifyListeners()
+
+    # The scheduler sees the raw state so that a candidate change is
+    # confirmed at the fast rate.
+    self._scheduler.update(raw_state,
+                           busy=(new_state & 0x01) or self.remotely_activated)
+    return True
 
   def run(self):
-    activation_count = 0
-
     self._running = True
+    cpx = None
 
     while self._running:
       try:
-        logger.info('Connecting to CPX...')
-        cpx = CircuitPlaygroundExpress()
-
-        logger.debug('Entering main CPX interaction loop.')
-        while self._running:
-          sensor_data = cpx.getSensorData()
-          if sensor_data == None:
-            continue
-          new_state,new_temperature = sensor_data
-          logger.debug('CPX State: {}, temperature: {}'.format(new_state, new_temperature))
-
-          if (self._state & 0x01) == 0:  # not activated
-            if new_state & 0x01:         # activate
-              if new_state > 3 or getSideDoorState() == 'Open'\
-                      or self.remotely_activated:
-                logger.debug('Turning on relay.')
-                os.system('relay-exp 0 1')
-              self.remotely_activated = False
-              activation_count += 1
-            elif self.remotely_activated:
-              logger.info('Requesting Activation...')
-              cpx.requestActivation()
-          elif self._state & 0x01:       # activated
-            self.remotely_activated = False
-            if (new_state & 0x01) == 0:  # deactivate
-              logger.debug('Turning off relay.')
-              os.system('relay-exp 0 0')
-            else:
-              # request deactivation
-              logger.info('Requesting Deactivation...')
-              cpx.requestDeactivation()
-
-          self._state = new_state
-
-          if new_temperature < 40.0:
-            self._temperature = new_temperature
-            # logger.debug('Temperature: {}*C'.format(temperature))
-
-          time.sleep(0.1)
-
+        if cpx is None:
+          logger.info('Connecting to CPX...')
+          cpx = CircuitPlaygroundExpress(recorder=self.recorder)
+          logger.debug('Entering main CPX interaction loop.')
+        if self.sample(cpx):
+          self._recovery.success()
+          self._scheduler.wait()
+          continue
+        logger.debug('Discarding invalid CPX frame.')
       except Exception as e:
         logger.debug(e)
-        logger.debug('Sleeping for 10 seconds before attempting to reconnect...')
-        time.sleep(10)
-        logger.debug('Attempting to reconnect...')
 
+      delay, reset = self._recovery.fault()
+      if reset and cpx is not None:
+        logger.info('Resetting the I2C bus after {} consecutive faults...'.format(
+          self._recovery.consecutive_faults))
+        try:
+          cpx.reset()
+        except Exception as e:
+          logger.debug(e)
+          cpx = None
+      if delay > 0:
+        logger.debug('Retrying the CPX in %.3f seconds...', delay)
+        time.sleep(delay)
@@ -1,16 +1,32 @@
 import logging
 
-from OmegaExpansion import onionI2C
+from garage.frames import FRAME_SIZE, decodeFrame
 
 logging.basicConfig(format='%(asctime)-15s %(message)s')
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 class CircuitPlaygroundExpress():
-  DATA_SIZE = 7
-
-  def __init__(self):
-    self.i2c = onionI2C.OnionI2C(0)
+  DATA_SIZE = FRAME_SIZE
+
+  def __init__(self, bus=0, recorder=None, i2c=None):
+    self._bus = bus
+    self._recorder = recorder
+    if i2c is None:
+      i2c = CircuitPlaygroundExpress.openBus(bus)
+    self.i2c = i2c
+
+  @staticmethod
+  def openBus(bus):
+    # Imported here so replay, benchmarks and simulations, which pass their
+    # own i2c, run without the Omega SDK.
+    from OmegaExpansion import onionI2C
+    return onionI2C.OnionI2C(bus)
+
+  def reset(self):
+    # Drop the device handle and open the bus again.
+    self.i2c = None
+    self.i2c = CircuitPlaygroundExpress.openBus(self._bus)
 
   def requestActivation(self):
     self.i2c.writeBytes(0x12, 0x00, [0xAA])
@@ -18,35 +34,8 @@ class CircuitPlaygroundExpress():
   def requestDeactivation(self):
     self.i2c.writeBytes(0x12, 0x00, [0xBB])
 
-  @classmethod
-  def fletcher16(cls, data):
-    # print(data)
-    sum1 = int(0)
-    sum2 = int(0)
-    for byte in data:
-      sum1 = (sum1 + byte) % 255
-      sum2 = (sum2 + sum1) % 255
-    return (sum2 << 8) | sum1
-
   def getSensorData(self):
     sensor_data = self.i2c.readBytes(0x12, 0x00, CircuitPlaygroundExpress.DATA_SIZE)
-    calculated_checksum = CircuitPlaygroundExpress.fletcher16(sensor_data[:-2])
-
-    checksum = 0
-    data_length = len(sensor_data)-2
-    for index in range(0, 2):
-      checksum += int(sensor_data[index+data_length])*(256**index)
-    if not calculated_checksum == checksum:
-      return None
-
-    state = int(sensor_data[0])
-    if state < 2 or state > 9:
-      return None
-
-    temperature = 0.0
-    for index in range(0, 4):
-      temperature += int(sensor_data[index+1])*(256**index)
-    temperature /= 100.0
-    # logger.debug('Data: {}, {}*C'.format(state, temperature))
-
-    return (state, temperature)
+    if self._recorder is not None:
+      self._recorder.recordFrame(sensor_data)
+    return decodeFrame(bytearray(sensor_data))
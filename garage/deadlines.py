@@ -0,0 +1,102 @@
+import heapq
+import logging
+import threading
+import time
+
+logging.basicConfig(format='%(asctime)-15s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+class DeadlineScheduler(threading.Thread):
+  '''
+  Keyed deadlines kept in a heap. Each key has at most one pending deadline;
+  arming a key again replaces it. Callbacks run on the scheduler thread at
+  their deadline, or from runDue() when the scheduler is driven by hand
+  (e.g. with a simulated clock during replay).
+  '''
+  def __init__(self, clock=time.time):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self._clock = clock
+    self._condition = threading.Condition()
+    self._heap = []
+    self._entries = {}
+    self._sequence = 0
+    self._running = False
+    self.fired_count = 0
+
+  def now(self):
+    return self._clock()
+
+  def arm(self, key, deadline, callback):
+    with self._condition:
+      self._sequence += 1
+      self._entries[key] = (deadline, self._sequence, callback)
+      heapq.heappush(self._heap, (deadline, self._sequence, key))
+      self._condition.notify()
+
+  def cancel(self, key):
+    with self._condition:
+      # The heap entry is dropped lazily once it reaches the top.
+      if self._entries.pop(key, None) is not None:
+        self._condition.notify()
+
+  def deadline(self, key):
+    with self._condition:
+      entry = self._entries.get(key)
+    if entry is None:
+      return None
+    return entry[0]
+
+  @property
+  def pending(self):
+    with self._condition:
+      return dict((key, entry[0]) for key, entry in self._entries.items())
+
+  def _popDue(self):
+    '''Returns (callback, delay until the next deadline); caller holds the lock.'''
+    while len(self._heap) > 0:
+      deadline, sequence, key = self._heap[0]
+      entry = self._entries.get(key)
+      if entry is None or entry[1] != sequence:
+        heapq.heappop(self._heap)
+        continue
+      delay = deadline - self._clock()
+      if delay > 0:
+        return (None, delay)
+      heapq.heappop(self._heap)
+      del self._entries[key]
+      return (entry[2], 0.0)
+    return (None, None)
+
+  def _fire(self, callback):
+    self.fired_count += 1
+    try:
+      callback()
+    except Exception as e:
+      logger.error('Deadline callback failed: {}'.format(e))
+
+  def runDue(self):
+    while True:
+      with self._condition:
+        callback, delay = self._popDue()
+      if callback is None:
+        return
+      self._fire(callback)
+
+  def stop(self):
+    with self._condition:
+      self._running = False
+      self._condition.notify()
+
+  def run(self):
+    self._running = True
+    while True:
+      with self._condition:
+        if not self._running:
+          return
+        callback, delay = self._popDue()
+        if callback is None:
+          self._condition.wait(delay)
+          continue
+      self._fire(callback)
@@ -0,0 +1,372 @@
+import json
+import logging
+import math
+import multiprocessing
+import queue
+import random
+import time
+
+from tinydb import TinyDB
+from tinydb.storages import MemoryStorage
+
+from garage.connector import GarageConnector, LocalControllerSource
+from garage.controller import GarageController
+from garage.cpx import CircuitPlaygroundExpress
+from garage.deadlines import DeadlineScheduler
+from garage.frames import encodeFrame
+from garage.monitor import GarageMonitor
+from garage.persistence import WriteBehindWriter
+from garage.publishing import PublishScheduler
+from garage.transport import LocalBroker, activateTopic, stateTopic
+
+logging.basicConfig(format='%(asctime)-15s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+class SimulatedClock(object):
+  '''Site time, running speedup times faster than the wall clock.'''
+  def __init__(self, speedup=1.0, start=None):
+    self.speedup = speedup
+    self._start = time.time() if start is None else start
+
+  def __call__(self):
+    return self._start + (time.time() - self._start)*self.speedup
+
+class SimulatedDoor(object):
+  '''
+  A garage door, its side door and the people using them. Trips and side
+  door visits are scheduled in simulated time; door travel takes real time
+  so the controller still samples the door moving.
+  '''
+  CLOSED = 2
+  OPEN = 4
+  FULLY_OPEN = 8
+
+  MEAN_TRIP_INTERVAL = 4*3600
+  MEDIAN_OPEN_TIME = 90
+  LEFT_OPEN_PROBABILITY = 0.05
+  MEAN_SIDE_DOOR_INTERVAL = 8*3600
+  SIDE_DOOR_OPEN_TIME = 60
+  TRAVEL_TIME = 2.0
+
+  def __init__(self, rng, clock):
+    self._rng = rng
+    self._clock = clock
+    self._target = SimulatedDoor.CLOSED
+    self._arrival = 0.0
+    self._settled = True
+    self._close_at = None
+    self._side_close_at = None
+    now = clock()
+    self._next_trip = now + rng.expovariate(1.0/SimulatedDoor.MEAN_TRIP_INTERVAL)
+    self._next_side = now + rng.expovariate(1.0/SimulatedDoor.MEAN_SIDE_DOOR_INTERVAL)
+    self.side = 'Closed'
+    self.trip_count = 0
+    self.left_open_count = 0
+    self.relay_count = 0
+
+  @property
+  def code(self):
+    if time.time() < self._arrival:
+      return SimulatedDoor.OPEN
+    return self._target
+
+  @property
+  def temperature(self):
+    return 15.0 + 10.0*math.sin(2*math.pi*self._clock()/86400.0)
+
+  def press(self):
+    '''Starts the door towards the other end, reversing it if it is moving.'''
+    now = time.time()
+    self._arrival = now + SimulatedDoor.TRAVEL_TIME - max(0.0, self._arrival - now)
+    if self._target == SimulatedDoor.CLOSED:
+      self._target = SimulatedDoor.FULLY_OPEN
+    else:
+      self._target = SimulatedDoor.CLOSED
+    self._settled = False
+    self._close_at = None
+
+  def setRelay(self, on):
+    if on:
+      self.relay_count += 1
+      self.press()
+
+  def sideDoor(self):
+    return self.side
+
+  def advance(self):
+    now = self._clock()
+    if self.side == 'Closed' and now >= self._next_side:
+      self.side = 'Open'
+      self._side_close_at = now + SimulatedDoor.SIDE_DOOR_OPEN_TIME
+    elif self.side == 'Open' and now >= self._side_close_at:
+      self.side = 'Closed'
+      self._next_side = now + self._rng.expovariate(1.0/SimulatedDoor.MEAN_SIDE_DOOR_INTERVAL)
+
+    if time.time() < self._arrival:
+      return
+    if not self._settled:
+      # Plan the next move once the door has come to rest.
+      self._settled = True
+      if self._target == SimulatedDoor.CLOSED:
+        self._next_trip = now + self._rng.expovariate(1.0/SimulatedDoor.MEAN_TRIP_INTERVAL)
+      elif self._rng.random() < SimulatedDoor.LEFT_OPEN_PROBABILITY:
+        self.left_open_count += 1
+      else:
+        self._close_at = now + self._rng.lognormvariate(
+          math.log(SimulatedDoor.MEDIAN_OPEN_TIME), 0.8)
+    elif self._target == SimulatedDoor.CLOSED and now >= self._next_trip:
+      self.trip_count += 1
+      self.press()
+    elif self._close_at is not None and now >= self._close_at:
+      self.press()
+
+class SimulatedI2C(object):
+  '''Stands in for onionI2C.OnionI2C on a CPX watching a SimulatedDoor.'''
+  def __init__(self, door):
+    self._door = door
+    self._activated = 0
+
+  def readBytes(self, address, register, count):
+    return list(encodeFrame(self._door.code | self._activated, self._door.temperature))
+
+  def writeBytes(self, address, register, data):
+    if data[0] == 0xAA:
+      self._activated = 1
+    elif data[0] == 0xBB:
+      self._activated = 0
+
+class SimulatedSite(object):
+  '''A GarageController and GarageConnector pair driven by a SimulatedDoor.'''
+  POLL_INTERVAL = 1.0  # GarageConnector.run() sleeps this long between polls
+
+  def __init__(self, thing_name, broker, clock, seed):
+    self.thing_name = thing_name
+    self.door = SimulatedDoor(random.Random(seed), clock)
+    self.cpx = CircuitPlaygroundExpress(i2c=SimulatedI2C(self.door))
+    self.controller = GarageController(side_door=self.door.sideDoor,
+                                       relay=self.door.setRelay)
+    self.connector = GarageConnector(scheduler=PublishScheduler(clock=clock),
+                                     local_transport=broker.client(thing_name),
+                                     source=LocalControllerSource(self.controller),
+                                     thing_name=thing_name,
+                                     side_door=self.door.sideDoor)
+    self.connector.connectLocal()
+    self._next_sample = 0.0
+    self._next_poll = 0.0
+
+  def step(self, now):
+    self.door.advance()
+    if now >= self._next_poll or self.connector.remotely_activated:
+      self.connector.poll()
+      self._next_poll = now + SimulatedSite.POLL_INTERVAL
+    if now >= self._next_sample or self.controller.remotely_activated:
+      self.controller.sample(self.cpx)
+      self._next_sample = now + self.controller.poll_interval
+
+  @property
+  def stats(self):
+    stats = self.connector.stats
+    stats['trips'] = self.door.trip_count
+    stats['left_open'] = self.door.left_open_count
+    stats['relay_presses'] = self.door.relay_count
+    return stats
+
+def runShard(names, outbound, inbound, speedup, duration, seed):
+  '''
+  Runs the sites of one shard for duration seconds. State reports are put
+  on outbound as (topic, payload); commands arrive the same way on inbound.
+  A final (None, stats) marks the end of the shard.
+  '''
+  for name in ('garage.connector', 'garage.controller'):
+    logging.getLogger(name).setLevel(logging.WARNING)
+  clock = SimulatedClock(speedup)
+  broker = LocalBroker()
+  uplink = broker.client('uplink')
+  uplink.connect()
+  uplink.subscribe(stateTopic('+'), 1,
+                   lambda client, userdata, message: outbound.put(message))
+  sites = [SimulatedSite(name, broker, clock, '{}:{}'.format(seed, name)) for name in names]
+
+  steps = 0
+  overruns = 0
+  end_time = time.time() + duration
+  while time.time() < end_time:
+    start_time = time.time()
+    while True:
+      try:
+        topic, payload = inbound.get_nowait()
+      except queue.Empty:
+        break
+      broker.publish(topic, payload)
+    for site in sites:
+      site.step(start_time)
+    steps += 1
+    elapsed = time.time() - start_time
+    if elapsed > FleetSimulator.TICK:
+      overruns += 1
+    else:
+      time.sleep(FleetSimulator.TICK - elapsed)
+
+  stats = {'steps': steps, 'overruns': overruns}
+  for site in sites:
+    for key, value in site.stats.items():
+      if key != 'heartbeat_interval':
+        stats[key] = stats.get(key, 0) + value
+  outbound.put((None, stats))
+
+class FleetMonitor(GarageMonitor):
+  '''GarageMonitor that counts emails instead of sending them.'''
+  def __init__(self, **kwargs):
+    GarageMonitor.__init__(self, **kwargs)
+    self._logger.setLevel(logging.WARNING)
+    self.email_count = 0
+    self.activation_count = 0
+
+  def sendEmail(self, shadow, init=False):
+    self.email_count += 1
+
+  def activateDoor(self):
+    self.activation_count += 1
+    GarageMonitor.activateDoor(self)
+
+class FleetSimulator(object):
+  '''
+  Runs site_count simulated sites, each under its own thing name, across
+  shard_count worker processes, and one FleetMonitor per site in this
+  process. The monitors share a deadline scheduler and an in-memory event
+  store. Reports travel over a multiprocessing queue into a LocalBroker;
+  auto-close commands travel back the same way.
+  '''
+  TICK = 0.05
+
+  def __init__(self, site_count, shard_count=None, speedup=60.0, duration=30.0, seed=0):
+    if shard_count is None:
+      shard_count = multiprocessing.cpu_count()
+    self.site_count = site_count
+    self.shard_count = max(1, min(shard_count, site_count))
+    self.speedup = speedup
+    self.duration = duration
+    self.seed = seed
+    self._latencies = []
+
+  def _measure(self, client, userdata, message):
+    # Subscribed after the monitors, so this runs once they have handled it.
+    self._latencies.append(time.time() - json.loads(message.payload)['timestamp'])
+
+  def run(self):
+    '''Runs the fleet to completion and returns a summary dict.'''
+    names = ['Garage{:05d}'.format(index) for index in range(self.site_count)]
+    shard_of = {}
+    for index, name in enumerate(names):
+      shard_of[name] = index % self.shard_count
+
+    # Start the workers before any threads exist in this process.
+    outbound = multiprocessing.Queue()
+    inbounds = [multiprocessing.Queue() for _ in range(self.shard_count)]
+    workers = []
+    for shard in range(self.shard_count):
+      worker = multiprocessing.Process(
+        target=runShard,
+        args=(names[shard::self.shard_count], outbound, inbounds[shard],
+              self.speedup, self.duration, self.seed))
+      worker.daemon = True
+      worker.start()
+      workers.append(worker)
+    start_time = time.time()
+
+    # Auto-close follows simulated time, but never fires while a retry could
+    # still catch the door travelling.
+    timeout_duration = max(GarageMonitor.timeout_duration/self.speedup,
+                           4*SimulatedDoor.TRAVEL_TIME)
+    broker = LocalBroker()
+    db = TinyDB(storage=MemoryStorage)
+    writer = WriteBehindWriter(db)
+    deadlines = DeadlineScheduler()
+    deadlines.start()
+    try:
+      monitors = []
+      for name in names:
+        monitor = FleetMonitor(db=db, local_transport=broker.client(name), thing_name=name,
+                               writer=writer, deadlines=deadlines,
+                               timeout_duration=timeout_duration)
+        monitor.connectLocal()
+        monitors.append(monitor)
+
+      def forward(client, userdata, message):
+        inbounds[shard_of[message.topic.split('/')[1]]].put(message)
+      router = broker.client('router')
+      router.connect()
+      router.subscribe(activateTopic('+'), 1, forward)
+      router.subscribe(stateTopic('+'), 1, self._measure)
+
+      self._latencies = []
+      shard_stats = []
+      messages = 0
+      # Delivered within the offered window, so the two rates compare.
+      on_time_messages = 0
+      max_backlog = 0
+      last_message_time = start_time
+      while len(shard_stats) < self.shard_count:
+        try:
+          topic, payload = outbound.get(timeout=1.0)
+        except queue.Empty:
+          if not any(worker.is_alive() for worker in workers):
+            break
+          continue
+        if topic is None:
+          shard_stats.append(payload)
+          continue
+        broker.publish(topic, payload)
+        messages += 1
+        last_message_time = time.time()
+        if last_message_time - start_time <= self.duration:
+          on_time_messages += 1
+        if messages % 100 == 0:
+          try:
+            max_backlog = max(max_backlog, outbound.qsize())
+          except NotImplementedError:
+            pass
+      for worker in workers:
+        worker.join()
+      for inbound in inbounds:
+        inbound.cancel_join_thread()
+    finally:
+      deadlines.stop()
+      writer.close()
+
+    totals = {}
+    for stats in shard_stats:
+      for key, value in stats.items():
+        totals[key] = totals.get(key, 0) + value
+    latencies = sorted(self._latencies)
+    def percentile(fraction):
+      if not latencies:
+        return 0.0
+      return latencies[min(len(latencies) - 1, int(fraction*len(latencies)))]
+
+    published = totals.get('change_publishes', 0) + totals.get('heartbeat_publishes', 0)
+    summary = {
+      'sites': self.site_count,
+      'shards': self.shard_count,
+      'speedup': self.speedup,
+      'duration': self.duration,
+      'messages': messages,
+      'offered_rate': published/self.duration,
+      'delivered_rate': on_time_messages/self.duration,
+      'drain_time': max(0.0, last_message_time - start_time - self.duration),
+      'max_backlog': max_backlog,
+      'latency_p50': percentile(0.5),
+      'latency_p95': percentile(0.95),
+      'latency_p99': percentile(0.99),
+      'latency_max': latencies[-1] if latencies else 0.0,
+      'trips': totals.get('trips', 0),
+      'left_open': totals.get('left_open', 0),
+      'auto_closes': sum([monitor.activation_count for monitor in monitors]),
+      'relay_presses': totals.get('relay_presses', 0),
+      'emails': sum([monitor.email_count for monitor in monitors]),
+      'shard_overruns': float(totals.get('overruns', 0))/max(totals.get('steps', 0), 1)
+    }
+    summary.update(('writer_' + key, value) for key, value in writer.stats.items()
+                   if key in ('queue_high_water', 'blocked_puts', 'dropped_records'))
+    return summary
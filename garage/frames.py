@@ -0,0 +1,92 @@
+import struct
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# A CPX frame, as written by CPX.ino: the door state, the temperature in
+# hundredths of a degree as a signed 32-bit integer, then the fletcher16
+# checksum of the first five bytes. Everything is little-endian.
+FRAME_FORMAT = '<BiH'
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+DATA_SIZE = FRAME_SIZE - 2
+MIN_STATE = 2
+MAX_STATE = 9
+
+if numpy is not None:
+  FRAME_DTYPE = numpy.dtype([('state', 'u1'), ('temp', '<i4'), ('checksum', '<u2')])
+  # Byte i of the data contributes (DATA_SIZE - i) times to sum2.
+  _WEIGHTS = numpy.arange(DATA_SIZE, 0, -1, dtype=numpy.uint32)
+
+def fletcher16(data):
+  '''
+  Fletcher-16 as computed by the firmware. Reducing once at the end gives
+  the same result as the per-byte modulo: sum1 is the plain byte sum and
+  sum2 weights byte i by its count of trailing bytes (n - i).
+  '''
+  sum1 = 0
+  sum2 = 0
+  for byte in data:
+    sum1 += byte
+    sum2 += sum1
+  return ((sum2 % 255) << 8) | (sum1 % 255)
+
+def _firmwareRound(value):
+  # Arduino's round() rounds halves away from zero.
+  if value >= 0:
+    return int(value + 0.5)
+  return int(value - 0.5)
+
+def encodeFrame(state, temperature):
+  '''Builds the frame the firmware would send for a state and temperature.'''
+  data = struct.pack('<Bi', state, _firmwareRound(temperature*100))
+  return data + struct.pack('<H', fletcher16(data))
+
+def decodeFrame(frame):
+  '''
+  Validates and decodes one frame. Returns (state, temperature) or None if
+  the frame is short, the checksum does not match or the state is invalid.
+  '''
+  if len(frame) < FRAME_SIZE:
+    return None
+  state, temperature, checksum = struct.unpack_from(FRAME_FORMAT, frame)
+  if checksum != fletcher16(memoryview(frame)[:DATA_SIZE]):
+    return None
+  if state < MIN_STATE or state > MAX_STATE:
+    return None
+  return (state, temperature/100.0)
+
+def decodeFrames(buffer):
+  '''
+  Validates and decodes a buffer of back-to-back frames. Returns
+  (valid, states, temperatures) with one entry per frame. With NumPy these
+  are arrays computed over a view of the buffer; otherwise they are lists.
+  '''
+  if len(buffer) % FRAME_SIZE:
+    raise ValueError('Buffer length is not a multiple of {} bytes'.format(FRAME_SIZE))
+  if numpy is None:
+    return _decodeFramesPython(buffer)
+
+  frames = numpy.frombuffer(buffer, dtype=FRAME_DTYPE)
+  data = numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(-1, FRAME_SIZE)[:, :DATA_SIZE]
+  sum1 = data.sum(axis=1, dtype=numpy.uint32) % 255
+  sum2 = data.dot(_WEIGHTS) % 255
+  states = frames['state']
+  valid = ((sum2 << 8) | sum1) == frames['checksum']
+  valid &= (states >= MIN_STATE) & (states <= MAX_STATE)
+  return (valid, states, frames['temp']/100.0)
+
+def _decodeFramesPython(buffer):
+  view = memoryview(buffer).cast('B')
+  valid = []
+  states = []
+  temperatures = []
+  offset = 0
+  for state, temperature, checksum in struct.iter_unpack(FRAME_FORMAT, view):
+    valid.append(checksum == fletcher16(view[offset:offset + DATA_SIZE]) and
+                 MIN_STATE <= state <= MAX_STATE)
+    states.append(state)
+    temperatures.append(temperature/100.0)
+    offset += FRAME_SIZE
+  return (valid, states, temperatures)
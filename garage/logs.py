@@ -0,0 +1,94 @@
+import atexit
+import collections
+import logging
+import logging.handlers
+import queue
+import threading
+
+LOG_FORMAT = '%(asctime)-15s %(message)s'
+
+class RingBufferHandler(logging.Handler):
+  '''
+  Keeps the most recent log records in memory. Records are stored as they
+  are; the message is only formatted when the buffer is viewed, so log
+  arguments must not be mutated after the call (log payload bytes, not
+  parsed shadows).
+  '''
+  CAPACITY = 1000
+
+  def __init__(self, capacity=CAPACITY):
+    logging.Handler.__init__(self)
+    self._records = collections.deque(maxlen=capacity)
+
+  def emit(self, record):
+    self._records.append(record)
+
+  def records(self, level=logging.NOTSET, limit=None):
+    if not isinstance(level, int):
+      level = logging.getLevelName(str(level).upper())
+      if not isinstance(level, int):
+        raise ValueError('Unknown log level')
+    records = [record for record in list(self._records) if record.levelno >= level]
+    if limit is not None:
+      records = records[-limit:]
+    return [{
+      'time': record.created,
+      'level': record.levelname,
+      'logger': record.name,
+      'thread': record.threadName,
+      'message': record.getMessage()
+    } for record in records]
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+  '''
+  QueueHandler that leaves formatting to the listener thread. The stock
+  prepare() formats the message on the logging thread.
+  '''
+  def prepare(self, record):
+    return record
+
+_ring_buffer = None
+_listener = None
+_lock = threading.Lock()
+
+def setupLogging(log_path=None, capacity=RingBufferHandler.CAPACITY,
+                 max_bytes=1024*1024, backup_count=3):
+  '''
+  Routes all logging to an in-memory ring buffer and, if log_path is given,
+  to a size-rotated file written by a background thread. The console
+  handler installed by logging.basicConfig is removed when logging to a
+  file. Returns the ring buffer handler.
+  '''
+  global _ring_buffer, _listener
+  with _lock:
+    root = logging.getLogger()
+    if _ring_buffer is None:
+      _ring_buffer = RingBufferHandler(capacity)
+      root.addHandler(_ring_buffer)
+
+    if log_path is not None and _listener is None:
+      for handler in list(root.handlers):
+        if isinstance(handler, logging.StreamHandler):
+          root.removeHandler(handler)
+      file_handler = logging.handlers.RotatingFileHandler(
+        log_path, maxBytes=max_bytes, backupCount=backup_count)
+      file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+      log_queue = queue.Queue(-1)
+      root.addHandler(DeferredQueueHandler(log_queue))
+      _listener = logging.handlers.QueueListener(log_queue, file_handler)
+      _listener.start()
+      atexit.register(shutdownLogging)
+    return _ring_buffer
+
+def ringBuffer():
+  if _ring_buffer is None:
+    return setupLogging()
+  return _ring_buffer
+
+def shutdownLogging():
+  '''Writes out anything still queued for the log file.'''
+  global _listener
+  with _lock:
+    if _listener is not None:
+      _listener.stop()
+      _listener = None
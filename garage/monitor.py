@@ -1,3 +1,4 @@
+import collections
 from datetime import datetime
 from dateutil import tz
 from enum import Enum
@@ -5,6 +6,7 @@ import json
 import logging
 import os
 import re
+import threading
 import time
 from tinydb import TinyDB
 
@@ -13,6 +15,10 @@ import requests
 import sendgrid
 from sendgrid.helpers import mail
 
+from garage.deadlines import DeadlineScheduler
+from garage.persistence import WriteBehindWriter
+from garage.transport import MQTTClient, activateTopic, stateTopic
+
 logging.basicConfig(format='%(asctime)-15s %(message)s')
 
 state_re = re.compile('<GarageState\.([A-Z][A-Z_]*):..*')
@@ -52,18 +58,56 @@ class GarageMonitor(object):
                       [GarageState.OPEN,          GarageState.CLOSED, GarageState.EXTENDED_OPEN, GarageState.UNKNOWN, GarageState.UNKNOWN],
                       [GarageState.EXTENDED_OPEN, GarageState.CLOSED, GarageState.EXTENDED_OPEN, GarageState.UNKNOWN, GarageState.UNKNOWN]]
   timeout_duration = 600
+  thing_name = 'GarageDoor'
+  aws_retry_interval = 30
+  http_timeout = 5
+  snapshot_interval = 30
 
-  def __init__(self):
+  def __init__(self, db=None, recorder=None, local_transport=None, deadlines=None,
+               writer=None, snapshot_path=None, thing_name=None, timeout_duration=None):
     self._logger = logging.getLogger(self.__class__.__name__)
     self._logger.setLevel(logging.DEBUG)
+    if thing_name is not None:
+      self.thing_name = thing_name
+    if timeout_duration is not None:
+      self.timeout_duration = timeout_duration
     self._config = None
     self._iot = None
     self._opened_time = None
     self.running = False
+    # Messages arrive on the AWS, LAN and deadline threads.
+    self._lock = threading.RLock()
     self.state = GarageState.UNKNOWN
     self.history = []
+    self.shadow = None
+    self.connector_online = None
     self._message_index = 0
-    self._db = TinyDB('event_db.json')
+    if db is None:
+      db = TinyDB('event_db.json')
+    self._db = db
+    if writer is None:
+      writer = WriteBehindWriter(db)
+    self.writer = writer
+    # A writer may be shared by several monitors.
+    if not self.writer.is_alive():
+      self.writer.start()
+    self.recorder = recorder
+    self._local = local_transport
+    if deadlines is None:
+      deadlines = DeadlineScheduler()
+    self.deadlines = deadlines
+    self._open_since = None
+    # Restored history arms the auto-close deadline only once the shadow
+    # get or a live report confirms the door is still in that state.
+    self._unconfirmed = False
+    self._recent_reports = collections.deque(maxlen=32)
+    self.local_message_count = 0
+    self.local_latency = None
+    self.max_local_latency = 0.0
+    self.snapshot_path = snapshot_path
+    self._snapshot_time = 0.0
+    self._snapshot_written = 0.0
+    self._snapshot_lock = threading.Lock()
 
   '''
   {
@@ -121,40 +165,243 @@ class GarageMonitor(object):
     },
   '''
   def handleEvent(self, event, shadow):
-    self._message_index = shadow['version']
-    self._logger.info('Event: {}'.format(event.type))
-    last_state = self.state
-    self.state = self.transition_table[self.state.value][event.type.value]
-    self._logger.info('Last State: {}\tCurrent State: {}'.format(last_state, self.state))
-    self.history.append(shadow)
-
-    if last_state != self.state or self.state == GarageState.EXTENDED_OPEN:
-      self.sendEmail(shadow, init=(event.type.value >= GarageEventType.INIT_OPEN.value))
-
-    if self.state == GarageState.EXTENDED_OPEN:
-      timestamps = []
-      for shadow in self.history:
-        timestamp = datetime.strptime(shadow['state']['reported']['Timestamp'], '%Y-%m-%d %H:%M:%S').timestamp()
-        if shadow['state']['reported']['SideDoorState'] == 'Closed' and \
-           shadow['state']['reported']['State'] == 'FullyOpen':
-          timestamps.append(timestamp)
-        elif len(timestamps) > 0:
-          timestamps = []
-      self._logger.debug('Timestamps:\n{}'.format(timestamps))
-      if len(timestamps) >= 2:
-        open_time = timestamps[-1] - timestamps[0]
-        self._logger.debug('Open Time: {}'.format(open_time))
-        if open_time >= GarageMonitor.timeout_duration:  # open for more than 10 minutes
-          self._logger.info('Garage was left open! Closing...')
-          requests.put('http://{}:5000/activate/'.format(self._config['controller_ip']))
-
-    if self.state == GarageState.CLOSED:
-      self.history = []
-    record = shadow['state']['reported']
-    record['version'] = shadow['version']
-    record['timestamp'] = datetime.strptime(record['Timestamp'], '%Y-%m-%d %H:%M:%S').replace(
+    with self._lock:
+      last_index = self._message_index
+      if 'version' in shadow:
+        self._message_index = shadow['version']
+      self._logger.info('Event: %s', event.type)
+      last_state = self.state
+      self.state = self.transition_table[self.state.value][event.type.value]
+      self._logger.info('Last State: %s\tCurrent State: %s', last_state, self.state)
+      self.history.append(shadow)
+      self.shadow = shadow
+
+      if last_state != self.state or self.state == GarageState.EXTENDED_OPEN:
+        self.sendEmail(shadow, init=(event.type.value >= GarageEventType.INIT_OPEN.value))
+
+      if self._unconfirmed:
+        self.confirmRestored(shadow, last_index)
+      else:
+        self.updateDeadline(shadow)
+
+      if self.state == GarageState.CLOSED:
+        self.history = []
+      record = shadow['state']['reported']
+      record['version'] = shadow.get('version')
+      record['timestamp'] = datetime.strptime(record['Timestamp'], '%Y-%m-%d %H:%M:%S').replace(
+        tzinfo=tz.tzutc()).timestamp()
+      self.writer.put(dict(record))
+
+      if last_state != self.state or\
+         time.time() - self._snapshot_time >= GarageMonitor.snapshot_interval:
+        self.saveSnapshot()
+
+  def saveSnapshot(self):
+    '''
+    Serializes the state machine and leaves writing it to the deadline
+    thread, so message callbacks never wait on the flash. A snapshot still
+    waiting to be written is replaced by the newer one.
+    '''
+    if self.snapshot_path is None:
+      return
+    snapshot = self.snapshotData()
+    if snapshot is None:
+      return
+    self.deadlines.arm('{}/snapshot'.format(self.thing_name), self.deadlines.now(),
+                       lambda: self.writeSnapshot(*snapshot))
+
+  def snapshotData(self):
+    '''Returns (saved time, JSON text) for the current state, or None if it cannot be encoded.'''
+    with self._lock:
+      saved = time.time()
+      try:
+        data = json.dumps({
+          'state': self.state.name,
+          'history': self.history,
+          'shadow': self.shadow,
+          'version': self._message_index,
+          'saved': saved
+        })
+      except (TypeError, ValueError) as e:
+        self._logger.error('Failed to encode the snapshot: {}'.format(e))
+        return None
+      self._snapshot_time = saved
+      return (saved, data)
+
+  def writeSnapshot(self, saved, data):
+    '''Writes a snapshot from snapshotData(), replacing the file atomically.'''
+    try:
+      temp_path = self.snapshot_path + '.tmp'
+      with self._snapshot_lock:
+        # A newer snapshot may already have been written by close().
+        if saved < self._snapshot_written:
+          return
+        with open(temp_path, 'w') as snapshot_file:
+          snapshot_file.write(data)
+        os.replace(temp_path, self.snapshot_path)
+        self._snapshot_written = saved
+    except (IOError, OSError) as e:
+      self._logger.error('Failed to save the snapshot: {}'.format(e))
+
+  def restore(self):
+    '''
+    Seeds the state machine, history and last version from the snapshot
+    file or, failing that, the event database, so the monitor is usable
+    before AWS answers the shadow get. Returns True if anything was restored.
+    '''
+    restored = self._restoreSnapshot() or self._restoreEvents()
+    if not restored:
+      return False
+    self._logger.info('Restored state %s (version %s, %d history entries)',
+                      self.state, self._message_index, len(self.history))
+    for shadow in self.history:
+      self._recent_reports.append(GarageMonitor.reportKey(shadow))
+    self._unconfirmed = True
+    return True
+
+  def confirmRestored(self, shadow, last_index):
+    '''
+    Arms the auto-close deadline for the first report after a restore. The
+    restored history only counts if the report directly follows it; after
+    missed reports or a state change the door may have moved in between, so
+    the deadline runs from the report itself.
+    '''
+    if shadow.get('version') != last_index + 1 or shadow['state']['reported']['StateUpdate']:
+      self._logger.info('Reports were missed since version %s; dropping the restored history',
+                        last_index)
+      self.history = [shadow]
+    self.rearmDeadline()
+
+  def rearmDeadline(self):
+    '''Arms the auto-close deadline from when the history shows the door was left open.'''
+    self._unconfirmed = False
+    for shadow in self.history:
+      self.updateDeadline(shadow)
+
+  def _restoreSnapshot(self):
+    if self.snapshot_path is None or not os.path.exists(self.snapshot_path):
+      return False
+    try:
+      with open(self.snapshot_path) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+      state = GarageState[snapshot['state']]
+    except (IOError, OSError, KeyError, ValueError) as e:
+      self._logger.error('Ignoring an unreadable snapshot: {}'.format(e))
+      return False
+    self.state = state
+    self.history = snapshot['history']
+    self.shadow = snapshot['shadow']
+    self._message_index = snapshot['version']
+    self._snapshot_time = snapshot['saved']
+    return True
+
+  @staticmethod
+  def recordShadow(record):
+    '''Rebuilds a shadow from a record written by handleEvent.'''
+    reported = dict(record)
+    version = reported.pop('version', None)
+    shadow = {'state': {'reported': reported}, 'timestamp': reported.pop('timestamp')}
+    if version is not None:
+      shadow['version'] = version
+    return shadow
+
+  @staticmethod
+  def allClosed(shadow):
+    return shadow['state']['reported']['State'] == 'Closed' and\
+           shadow['state']['reported']['SideDoorState'] == 'Closed'
+
+  def _restoreEvents(self):
+    records = self._db.all()
+    if len(records) == 0:
+      return False
+    self._message_index = max([record.get('version') or 0 for record in records])
+
+    # Only the reports since the door last closed matter; replay those
+    # through the state machine without side effects.
+    shadows = []
+    state = GarageState.UNKNOWN
+    for record in reversed(records):
+      shadow = GarageMonitor.recordShadow(record)
+      if GarageMonitor.allClosed(shadow):
+        state = GarageState.CLOSED
+        self.shadow = shadow
+        break
+      shadows.append(shadow)
+    self.state = state
+    for shadow in reversed(shadows):
+      self.state = self.transition_table[self.state.value][self.eventType(shadow).value]
+      self.history.append(shadow)
+      self.shadow = shadow
+    return True
+
+  @staticmethod
+  def reportTime(shadow):
+    if 'timestamp' in shadow:
+      return shadow['timestamp']
+    return datetime.strptime(shadow['state']['reported']['Timestamp'], '%Y-%m-%d %H:%M:%S').replace(
       tzinfo=tz.tzutc()).timestamp()
-    self._db.insert(record)
+
+  @staticmethod
+  def leftOpen(shadow):
+    return shadow['state']['reported']['State'] == 'FullyOpen' and\
+           shadow['state']['reported']['SideDoorState'] == 'Closed'
+
+  def updateDeadline(self, shadow):
+    '''Arms the auto-close deadline when the door is left open and cancels it otherwise.'''
+    if GarageMonitor.leftOpen(shadow):
+      if self._open_since is None:
+        self._open_since = GarageMonitor.reportTime(shadow)
+        self._logger.debug('Auto-close armed for %s',
+                           self._open_since + self.timeout_duration)
+        self.deadlines.arm(self.thing_name,
+                           self._open_since + self.timeout_duration,
+                           self.autoClose)
+    elif self._open_since is not None:
+      self._logger.debug('Auto-close cancelled')
+      self._open_since = None
+      self.deadlines.cancel(self.thing_name)
+
+  def autoClose(self):
+    with self._lock:
+      if len(self.history) == 0 or not GarageMonitor.leftOpen(self.history[-1]):
+        return
+      self._logger.info('Garage was left open! Closing...')
+      self.activateDoor()
+      # Try again after another timeout if the door does not move.
+      self.deadlines.arm(self.thing_name,
+                         self.deadlines.now() + self.timeout_duration,
+                         self.autoClose)
+
+  def activateDoor(self):
+    if self._local is not None:
+      try:
+        self._local.publish(activateTopic(self.thing_name), json.dumps({'timestamp': time.time()}), 1)
+        return
+      except Exception as e:
+        self._logger.error('Local activation failed, falling back to HTTP: {}'.format(e))
+    requests.put('http://{}:5000/activate/'.format(self._config['controller_ip']),
+                 timeout=GarageMonitor.http_timeout)
+
+  @property
+  def stats(self):
+    stats = self.writer.stats
+    stats.update({
+      'local_messages': self.local_message_count,
+      'local_latency': self.local_latency,
+      'max_local_latency': self.max_local_latency,
+      'connector_online': self.connector_online
+    })
+    return stats
+
+  def close(self):
+    try:
+      self.deadlines.stop()
+      if self.snapshot_path is not None:
+        snapshot = self.snapshotData()
+        if snapshot is not None:
+          self.writeSnapshot(*snapshot)
+    finally:
+      self.writer.close()
 
   def onlineCallback(self, client):
     self._logger.warn('Connected to AWS IoT')
@@ -166,21 +413,28 @@ class GarageMonitor(object):
 
   def getCallback(self, client, userdata, message):
     topic = message.topic
+    if self.recorder is not None:
+      self.recorder.recordShadow(topic, message.payload)
     self._logger.debug(topic)
-    self._logger.debug('Message: {}'.format(dir(message)))
     if topic.endswith('accepted'):
       shadow = json.loads(message.payload)
-      self._logger.debug('Fetched Shadow:\n{}'.format(shadow))
+      self._logger.debug('Fetched Shadow:\n%s', message.payload)
 
-      mainState = shadow['state']['reported']['State']
-      sideState = shadow['state']['reported']['SideDoorState']
-      event = None
-      if mainState == 'Closed' and sideState == 'Closed':
-        event = GarageEvent(GarageEventType.INIT_CLOSED, shadow)
-      else:
-        event = GarageEvent(GarageEventType.INIT_OPEN, shadow)
+      with self._lock:
+        if self.state != GarageState.UNKNOWN:
+          self.reconcile(shadow)
+          self._finished = True
+          return
 
-      self.handleEvent(event, shadow)
+        mainState = shadow['state']['reported']['State']
+        sideState = shadow['state']['reported']['SideDoorState']
+        event = None
+        if mainState == 'Closed' and sideState == 'Closed':
+          event = GarageEvent(GarageEventType.INIT_CLOSED, shadow)
+        else:
+          event = GarageEvent(GarageEventType.INIT_OPEN, shadow)
+
+        self.handleEvent(event, shadow)
     elif topic.endswith('rejected'):
       self._logger.error('The status request was rejected.')
     else:
@@ -189,42 +443,93 @@ class GarageMonitor(object):
 
   def updateCallback(self, client, userdata, message):
     topic = message.topic
+    if self.recorder is not None:
+      self.recorder.recordShadow(topic, message.payload)
     self._logger.debug(topic)
     if topic.endswith('accepted'):
       shadow = json.loads(message.payload)
-      self._logger.info('A shadow update was accepted:\n{}'.format(shadow))
+      self._logger.debug('A shadow update was accepted:\n%s', message.payload)
 
-      if shadow['version'] <= self._message_index:
-        self._logger.info('Skipping repeat message with index {}'.format(shadow['version']))
-        return
+      with self._lock:
+        if shadow['version'] <= self._message_index:
+          self._logger.info('Skipping repeat message with index %s', shadow['version'])
+          return
 
-      mainState = shadow['state']['reported']['State']
-      sideState = shadow['state']['reported']['SideDoorState']
-      stateUpdate = shadow['state']['reported']['StateUpdate']
-      event = None
-      if stateUpdate:
-        if mainState == 'Closed' and sideState == 'Closed':
-          event = GarageEvent(GarageEventType.ALL_CLOSED, shadow)
-        else:
-          event = GarageEvent(GarageEventType.ANY_OPENED, shadow)
-      else:
-        if mainState == 'Closed' and sideState == 'Closed':
-          if self.state != GarageState.CLOSED:
-            event = GarageEvent(GarageEventType.ALL_CLOSED, shadow)
-          else:
-            event = GarageEvent(GarageEventType.PERIODIC_UPDATE, shadow)
-        else:
-          if self.state != GarageState.OPEN:
-            event = GarageEvent(GarageEventType.ANY_OPENED, shadow)
-          else:
-            event = GarageEvent(GarageEventType.PERIODIC_UPDATE, shadow)
+        if self.alreadyHandled(shadow):
+          self._logger.info('Skipping message %s already received locally', shadow['version'])
+          self._message_index = shadow['version']
+          return
 
-      self.handleEvent(event, shadow)
+        self.handleUpdate(shadow)
     elif topic.endswith('rejected'):
       self._logger.debug('A shadow update was rejected.')
     else:
       self._logger.warn('Received an unhandled update for topic {}.'.format(topic))
 
+  def reconcile(self, shadow):
+    '''Brings restored state up to date with the shadow fetched from AWS.'''
+    if shadow.get('version', 0) <= self._message_index or self.alreadyHandled(shadow):
+      self._logger.info('Restored state %s is up to date', self.state)
+      self._message_index = max(self._message_index, shadow.get('version', 0))
+      # The last known report is confirmed, so its auto-close deadline stands.
+      if self._unconfirmed:
+        self.rearmDeadline()
+      return
+    self._logger.info('Reconciling restored state %s with version %s',
+                      self.state, shadow.get('version'))
+    self.handleUpdate(shadow)
+
+  @staticmethod
+  def reportKey(shadow):
+    reported = shadow['state']['reported']
+    return (reported['Timestamp'], reported['State'], reported['SideDoorState'],
+            reported['StateUpdate'])
+
+  def alreadyHandled(self, shadow):
+    return GarageMonitor.reportKey(shadow) in self._recent_reports
+
+  def eventType(self, shadow):
+    '''Classifies a report relative to the current state.'''
+    closed = GarageMonitor.allClosed(shadow)
+    if shadow['state']['reported']['StateUpdate']:
+      if closed:
+        return GarageEventType.ALL_CLOSED
+      return GarageEventType.ANY_OPENED
+    if closed:
+      if self.state != GarageState.CLOSED:
+        return GarageEventType.ALL_CLOSED
+      return GarageEventType.PERIODIC_UPDATE
+    if self.state != GarageState.OPEN:
+      return GarageEventType.ANY_OPENED
+    return GarageEventType.PERIODIC_UPDATE
+
+  def handleUpdate(self, shadow):
+    with self._lock:
+      self._recent_reports.append(GarageMonitor.reportKey(shadow))
+      self.handleEvent(GarageEvent(self.eventType(shadow), shadow), shadow)
+
+  def localCallback(self, client, userdata, message):
+    '''Shadow reports published by the connector straight over the LAN.'''
+    if self.recorder is not None:
+      self.recorder.recordShadow(message.topic, message.payload)
+    shadow = json.loads(message.payload)
+    self.local_message_count += 1
+    if 'timestamp' in shadow:
+      self.local_latency = time.time() - shadow['timestamp']
+      self.max_local_latency = max(self.max_local_latency, self.local_latency)
+    with self._lock:
+      if self.alreadyHandled(shadow):
+        return
+      self.handleUpdate(shadow)
+
+  def statusCallback(self, client, userdata, message):
+    status = json.loads(message.payload)
+    self.connector_online = status.get('Connected', False)
+    if self.connector_online:
+      self._logger.info('The garage connector is online.')
+    else:
+      self._logger.warn('The garage connector went offline.')
+
   def sendEmail(self, shadow, init=False):
     self._logger.info('Sending email update...')
     intro = 'The garage door changed state'
@@ -241,7 +546,7 @@ class GarageMonitor(object):
                 shadow['state']['reported']['State'],
                 shadow['state']['reported']['SideDoorState'],
                 shadow['state']['reported']['Temperature'],
-                shadow['version'])
+                shadow.get('version'))
     for datum in self.history:
       gmt_timestamp = datetime.strptime(
         datum['state']['reported']['Timestamp'],
@@ -252,7 +557,11 @@ class GarageMonitor(object):
         datum['state']['reported']['State'],
         datum['state']['reported']['SideDoorState'],
         local_timestamp.strftime("%Y-%m-%d %H:%M:%S %Z"))
-    self._logger.info('Message:{}'.format(message))
+    self._logger.debug('Message:%s', message)
+    self.deliverEmail(message)
+
+  def deliverEmail(self, message):
+    '''Sends a status email body through SendGrid.'''
     sg = sendgrid.SendGridAPIClient(self._config['sgkey'])
     data = {
       "personalizations": [
@@ -284,6 +593,13 @@ class GarageMonitor(object):
   def connect(self):
     with open('config.json') as config_file:
       self._config = json.load(config_file)
+
+    if self._local is None and self._config.get('localbroker'):
+      self._local = MQTTClient.fromAddress(self._config['localbroker'],
+                                           self._config['clientid'])
+    if self._local is not None:
+      self.connectLocal()
+
     aws_host = self._config['awshost']
     aws_port = self._config['awsport']
 
@@ -295,34 +611,52 @@ class GarageMonitor(object):
     self._iot.configureEndpoint(aws_host, aws_port)
     self._iot.configureCredentials(caPath, keyPath, certPath)
 
-    start_time = time.time()
-    state = ''
-    last_state = ''
-    data = None
+    if not self.deadlines.is_alive():
+      self.deadlines.start()
 
     self._logger.debug('Starting shadow monitor main outer loop...')
+    self.scheduleAWS(0)
 
+    self._logger.debug('Garage Monitor Started')
+    self.running = True
+
+  def connectLocal(self):
+    self._logger.info('Connecting to the local broker...')
+    try:
+      self._local.connect()
+      self._local.subscribe(stateTopic(self.thing_name), 1, self.localCallback)
+    except Exception as e:
+      self._logger.error('Failed to connect to the local broker: {}'.format(e))
+
+  def scheduleAWS(self, delay):
+    '''Connects to AWS on a background timer so callers never block on the uplink.'''
+    connection = threading.Timer(delay, self.connectAWS)
+    connection.daemon = True
+    connection.start()
+
+  def connectAWS(self):
     self._logger.info('Connecting to AWS...')
-    self._iot.connect()
+    try:
+      self._iot.connect()
+    except Exception as e:
+      # Keep serving the restored state and retry the uplink in the background.
+      self._logger.error('Failed to connect to AWS, retrying in {} seconds: {}'.format(
+        GarageMonitor.aws_retry_interval, e))
+      self.scheduleAWS(GarageMonitor.aws_retry_interval)
+      return
 
+    shadow_topic = '$aws/things/{}/shadow'.format(self.thing_name)
     self._logger.info('Subscribing for Shadow Updates...')
-    self._iot.subscribe("$aws/things/GarageDoor/shadow/update/accepted", 1,
-                        self.updateCallback)
-    self._iot.subscribe("$aws/things/GarageDoor/shadow/update/rejected", 1,
-                        self.updateCallback)
+    self._iot.subscribe(shadow_topic + "/update/accepted", 1, self.updateCallback)
+    self._iot.subscribe(shadow_topic + "/update/rejected", 1, self.updateCallback)
     '''
-    self._iot.subscribe("$aws/things/GarageDoor/shadow/update/delta", 1,
-                        self.updateCallback)
+    self._iot.subscribe(shadow_topic + "/update/delta", 1, self.updateCallback)
     '''
+    self._iot.subscribe('{}/connector/status'.format(self.thing_name), 1,
+                        self.statusCallback)
     self._logger.info('Subscribed for Shadow Updates.')
 
     self._logger.info('Fetching the shadow status...')
-    self._iot.subscribe("$aws/things/GarageDoor/shadow/get/accepted", 1,
-                        self.getCallback)
-    self._iot.subscribe("$aws/things/GarageDoor/shadow/get/rejected", 1,
-                        self.getCallback)
-    self._iot.publish("$aws/things/GarageDoor/shadow/get", "", 1)
-
-    self._logger.debug('Garage Monitor Started')
-    self.running = True
-
+    self._iot.subscribe(shadow_topic + "/get/accepted", 1, self.getCallback)
+    self._iot.subscribe(shadow_topic + "/get/rejected", 1, self.getCallback)
+    self._iot.publish(shadow_topic + "/get", "", 1)
@@ -1,5 +1,6 @@
 import json
 import logging
+import os
 import subprocess
 
 logging.basicConfig(format='%(asctime)-15s %(message)s')
@@ -19,13 +20,16 @@ def getSideDoorState():
     gpio_data_raw = subprocess.check_output(
       ["/bin/ubus", "call", "onion", "gpio", json.dumps(get_params)])
     gpio_data = json.loads(gpio_data_raw)
-  logger.debug('GPIO Data: {}'.format(gpio_data))
+  logger.debug('GPIO Data: %s', gpio_data)
 
   state = 'Closed'
   if gpio_data['value'] == '1':
     state = 'Open'
   return state
 
+def setRelay(on):
+  os.system('relay-exp 0 {}'.format(1 if on else 0))
+
 def getSignalStrengths():
   wifi_data_raw = subprocess.check_output(["/bin/ubus", "call", "onion", "wifi-scan", "{\'device\':\'ra0\'}"])
   wifi_data = json.loads(wifi_data_raw)
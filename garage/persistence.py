@@ -0,0 +1,157 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+logging.basicConfig(format='%(asctime)-15s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+class WriteBehindWriter(threading.Thread):
+  '''
+  Write-behind persistence for a TinyDB table. put() queues a record and
+  returns; the writer thread collects whatever arrives within
+  COMMIT_INTERVAL of the first queued record (up to BATCH_SIZE records),
+  inserts the batch with a single write. The database file is fsynced
+  FSYNC_INTERVAL seconds after the first commit that has not been synced,
+  whether or not more records arrive. When the queue is full put() blocks
+  for up to PUT_TIMEOUT seconds before dropping the record.
+  '''
+  QUEUE_SIZE = 1000
+  BATCH_SIZE = 100
+  COMMIT_INTERVAL = 0.5
+  FSYNC_INTERVAL = 5.0
+  PUT_TIMEOUT = 1.0
+
+  def __init__(self, db, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE,
+               commit_interval=COMMIT_INTERVAL, fsync_interval=FSYNC_INTERVAL):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self._db = db
+    self._queue = queue.Queue(queue_size)
+    self._batch_size = batch_size
+    self._commit_interval = commit_interval
+    self.fsync_interval = fsync_interval
+    self._running = False
+    self._closed = False
+    self._dirty_since = None
+    self.queued_count = 0
+    self.committed_count = 0
+    self.commit_count = 0
+    self.sync_count = 0
+    self.blocked_count = 0
+    self.blocked_time = 0.0
+    self.dropped_count = 0
+    self.high_water = 0
+    self.last_commit_time = 0.0
+
+  def put(self, record):
+    try:
+      self._queue.put_nowait(record)
+    except queue.Full:
+      self.blocked_count += 1
+      start_time = time.time()
+      try:
+        self._queue.put(record, timeout=WriteBehindWriter.PUT_TIMEOUT)
+      except queue.Full:
+        self.dropped_count += 1
+        logger.error('Persistence queue is full; dropping a record')
+        return
+      finally:
+        self.blocked_time += time.time() - start_time
+    self.queued_count += 1
+    self.high_water = max(self.high_water, self._queue.qsize())
+
+  def _collect(self):
+    try:
+      if self._running:
+        batch = [self._queue.get(timeout=self._commit_interval)]
+      else:
+        batch = [self._queue.get_nowait()]
+    except queue.Empty:
+      return []
+    deadline = time.time() + self._commit_interval
+    while len(batch) < self._batch_size:
+      remaining = deadline - time.time()
+      try:
+        if remaining > 0 and self._running:
+          batch.append(self._queue.get(timeout=remaining))
+        else:
+          batch.append(self._queue.get_nowait())
+      except queue.Empty:
+        break
+    return batch
+
+  def commit(self, batch):
+    start_time = time.time()
+    try:
+      self._db.insert_multiple(batch)
+    except Exception as e:
+      logger.error('Failed to write {} records: {}'.format(len(batch), e))
+      return
+    self.commit_count += 1
+    self.committed_count += len(batch)
+    if self._dirty_since is None:
+      self._dirty_since = start_time
+    self._syncIfDue()
+    self.last_commit_time = time.time() - start_time
+
+  def _syncIfDue(self):
+    if self._dirty_since is not None and\
+       time.time() - self._dirty_since >= self.fsync_interval:
+      self.sync()
+
+  def sync(self):
+    # TinyDB's JSONStorage flushes but never fsyncs its file handle.
+    storage = getattr(self._db, 'storage', None) or getattr(self._db, '_storage', None)
+    handle = getattr(storage, '_handle', None)
+    if handle is not None:
+      handle.flush()
+      os.fsync(handle.fileno())
+      self.sync_count += 1
+    self._dirty_since = None
+
+  def close(self):
+    '''Commits everything still queued and fsyncs.'''
+    self._running = False
+    if self.is_alive():
+      self.join()
+    else:
+      self._drain()
+    if not self._closed:
+      self._closed = True
+      self.sync()
+
+  def _drain(self):
+    batch = self._collect()
+    while len(batch) > 0:
+      self.commit(batch)
+      batch = self._collect()
+
+  def run(self):
+    self._running = True
+    while self._running:
+      batch = self._collect()
+      if len(batch) > 0:
+        self.commit(batch)
+      else:
+        # _collect() waits at most COMMIT_INTERVAL, so an idle writer
+        # still syncs its last batch on time.
+        self._syncIfDue()
+    self._drain()
+
+  @property
+  def stats(self):
+    return {
+      'queue_depth': self._queue.qsize(),
+      'queue_high_water': self.high_water,
+      'queued_records': self.queued_count,
+      'committed_records': self.committed_count,
+      'commits': self.commit_count,
+      'fsyncs': self.sync_count,
+      'blocked_puts': self.blocked_count,
+      'blocked_time': self.blocked_time,
+      'dropped_records': self.dropped_count,
+      'last_commit_time': self.last_commit_time
+    }
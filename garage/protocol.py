@@ -0,0 +1,19 @@
+import struct
+import time
+
+# Compact status sample: state code (GarageController.STATE_NAMES index),
+# temperature in hundredths of a degree C and the sample time in Unix seconds.
+STATUS_FORMAT = '<BhI'
+STATUS_SIZE = struct.calcsize(STATUS_FORMAT)
+
+# Client command bytes, matching the requests the CPX firmware accepts.
+ACTIVATE_COMMAND = 0xAA
+
+def encodeStatus(state, temperature, timestamp=None):
+  if timestamp is None:
+    timestamp = time.time()
+  return struct.pack(STATUS_FORMAT, state, int(round(temperature*100)), int(timestamp))
+
+def decodeStatus(data):
+  state, temperature, timestamp = struct.unpack(STATUS_FORMAT, data[:STATUS_SIZE])
+  return (state, temperature/100.0, timestamp)
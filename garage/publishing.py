@@ -0,0 +1,115 @@
+import time
+
+class TokenBucket(object):
+  def __init__(self, rate, capacity, clock=time.time):
+    self._rate = rate
+    self._capacity = capacity
+    self._clock = clock
+    self._tokens = float(capacity)
+    self._last = clock()
+
+  def _refill(self):
+    now = self._clock()
+    self._tokens = min(self._capacity, self._tokens + (now - self._last)*self._rate)
+    self._last = now
+
+  def available(self):
+    self._refill()
+    return self._tokens >= 1.0
+
+  def consume(self):
+    if self.available():
+      self._tokens -= 1.0
+      return True
+    return False
+
+class PublishScheduler(object):
+  '''
+  Decides when GarageConnector publishes a shadow update.
+
+  A state change is published right away unless another change was
+  published less than SETTLE_TIME seconds ago; in that case the latest state
+  is published once the window has passed, so states that only last inside
+  the window are coalesced away. Change publishes are also limited by a
+  token bucket, charged only once a change has actually been published so
+  a failed attempt is retried on the next poll. Without changes a heartbeat
+  is sent every heartbeat_interval seconds; the interval doubles up to MAX_HEARTBEAT while everything is
+  closed, because connection liveness is covered by the MQTT keepalive and
+  last will, and stays at MIN_HEARTBEAT while anything is open.
+  '''
+  CHANGE = 'change'
+  HEARTBEAT = 'heartbeat'
+
+  SETTLE_TIME = 2.0
+  RATE = 0.1
+  BURST = 4
+  MIN_HEARTBEAT = 600
+  MAX_HEARTBEAT = 3600
+
+  def __init__(self, settle_time=SETTLE_TIME, rate=RATE, burst=BURST,
+               min_heartbeat=MIN_HEARTBEAT, max_heartbeat=MAX_HEARTBEAT,
+               clock=time.time):
+    self._settle_time = settle_time
+    self._bucket = TokenBucket(rate, burst, clock)
+    self._min_heartbeat = min_heartbeat
+    self._max_heartbeat = max_heartbeat
+    self._clock = clock
+    self._published_key = None
+    self._deferred_key = None
+    self._last_publish = 0.0
+    self._last_change = 0.0
+    self.heartbeat_interval = min_heartbeat
+    self.change_count = 0
+    self.heartbeat_count = 0
+    self.deferred_count = 0
+
+  @classmethod
+  def stateKey(cls, state):
+    return (state['main'], state['side'])
+
+  @property
+  def published_key(self):
+    return self._published_key
+
+  def due(self, state):
+    '''Returns CHANGE, HEARTBEAT or None for the given full connector state.'''
+    now = self._clock()
+    key = PublishScheduler.stateKey(state)
+    if key != self._published_key:
+      if now - self._last_change >= self._settle_time and self._bucket.available():
+        return PublishScheduler.CHANGE
+      # Count each deferred state once, however many polls it waits.
+      if key != self._deferred_key:
+        self._deferred_key = key
+        self.deferred_count += 1
+      return None
+    self._deferred_key = None
+    if now - self._last_publish >= self.heartbeat_interval:
+      return PublishScheduler.HEARTBEAT
+    return None
+
+  def published(self, state, kind):
+    now = self._clock()
+    self._last_publish = now
+    self._published_key = PublishScheduler.stateKey(state)
+    self._deferred_key = None
+    if kind == PublishScheduler.CHANGE:
+      self._bucket.consume()
+      self._last_change = now
+      self.change_count += 1
+      self.heartbeat_interval = self._min_heartbeat
+    else:
+      self.heartbeat_count += 1
+      if state['main'] == 'Closed' and state['side'] == 'Closed':
+        self.heartbeat_interval = min(self._max_heartbeat, self.heartbeat_interval*2)
+      else:
+        self.heartbeat_interval = self._min_heartbeat
+
+  @property
+  def stats(self):
+    return {
+      'change_publishes': self.change_count,
+      'heartbeat_publishes': self.heartbeat_count,
+      'deferred_changes': self.deferred_count,
+      'heartbeat_interval': self.heartbeat_interval
+    }
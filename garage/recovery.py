@@ -0,0 +1,64 @@
+import random
+import time
+
+class RecoveryPolicy(object):
+  '''
+  Paces recovery from sensor link faults. The first few consecutive faults
+  are retried immediately, later ones back off exponentially with jitter,
+  and every RESET_AFTER consecutive faults the caller is told to reset the
+  bus. Recovery time is measured from the first fault to the next success.
+  '''
+  IMMEDIATE_RETRIES = 2
+  BASE_DELAY = 0.05
+  MAX_DELAY = 5.0
+  RESET_AFTER = 5
+
+  def __init__(self, immediate_retries=IMMEDIATE_RETRIES, base_delay=BASE_DELAY,
+               max_delay=MAX_DELAY, reset_after=RESET_AFTER):
+    self._immediate_retries = immediate_retries
+    self._base_delay = base_delay
+    self._max_delay = max_delay
+    self._reset_after = reset_after
+    self._fault_start = None
+    self.consecutive_faults = 0
+    self.fault_count = 0
+    self.reset_count = 0
+    self.recovery_count = 0
+    self.last_recovery_time = 0.0
+    self.max_recovery_time = 0.0
+
+  def fault(self):
+    '''Record a fault and return (delay in seconds, whether to reset the bus).'''
+    if self._fault_start is None:
+      self._fault_start = time.time()
+    self.fault_count += 1
+    self.consecutive_faults += 1
+
+    reset = self.consecutive_faults % self._reset_after == 0
+    if reset:
+      self.reset_count += 1
+
+    retries = self.consecutive_faults - self._immediate_retries
+    if retries <= 0:
+      return (0.0, reset)
+    delay = min(self._max_delay, self._base_delay * 2**(retries - 1))
+    return (random.uniform(delay/2, delay), reset)
+
+  def success(self):
+    if self._fault_start is not None:
+      self.last_recovery_time = time.time() - self._fault_start
+      self.max_recovery_time = max(self.max_recovery_time, self.last_recovery_time)
+      self.recovery_count += 1
+      self._fault_start = None
+    self.consecutive_faults = 0
+
+  @property
+  def stats(self):
+    return {
+      'fault_count': self.fault_count,
+      'consecutive_faults': self.consecutive_faults,
+      'reset_count': self.reset_count,
+      'recovery_count': self.recovery_count,
+      'last_recovery_time': self.last_recovery_time,
+      'max_recovery_time': self.max_recovery_time
+    }
@@ -0,0 +1,144 @@
+import collections
+import logging
+import time
+
+from tinydb import TinyDB
+from tinydb.storages import MemoryStorage
+
+from garage.capture import CPX_FRAME, GPIO_EDGE, SHADOW, splitShadow
+from garage.controller import GarageController
+from garage.cpx import CircuitPlaygroundExpress
+from garage.deadlines import DeadlineScheduler
+from garage.frames import FRAME_SIZE, decodeFrames
+from garage.monitor import GarageMonitor
+
+logging.basicConfig(format='%(asctime)-15s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ReplayMessage = collections.namedtuple('ReplayMessage', ['topic', 'payload'])
+
+class ReplayI2C(object):
+  '''Stands in for onionI2C.OnionI2C, returning the most recent captured frame.'''
+  def __init__(self):
+    self.frame = [0]*CircuitPlaygroundExpress.DATA_SIZE
+    self.write_count = 0
+
+  def readBytes(self, address, register, count):
+    return list(self.frame)
+
+  def writeBytes(self, address, register, data):
+    self.write_count += 1
+
+class ReplayMonitor(GarageMonitor):
+  '''
+  GarageMonitor with its email delivery, HTTP and disk side effects replaced
+  by counters. Email bodies are still formatted, since that cost grows with
+  the history.
+  '''
+  def __init__(self, **kwargs):
+    kwargs.setdefault('db', TinyDB(storage=MemoryStorage))
+    GarageMonitor.__init__(self, **kwargs)
+    self._logger.setLevel(logging.WARNING)
+    self.email_count = 0
+    self.activation_count = 0
+
+  def deliverEmail(self, message):
+    self.email_count += 1
+
+  def activateDoor(self):
+    self.activation_count += 1
+
+class Replayer(object):
+  '''
+  Feeds capture records back through CircuitPlaygroundExpress,
+  GarageController and GarageMonitor. A speed of 1.0 replays in real time,
+  higher values proportionally faster and 0 as fast as possible.
+  '''
+  def __init__(self, speed=0.0, monitor=None):
+    self._speed = speed
+    self.side_door_state = 'Closed'
+    self.i2c = ReplayI2C()
+    self.cpx = CircuitPlaygroundExpress(i2c=self.i2c)
+    self.controller = GarageController(side_door=lambda: self.side_door_state,
+                                       relay=self._setRelay)
+    self.controller.addListener(self._controllerChanged)
+    # Monitor deadlines follow capture time rather than the wall clock.
+    self._now = 0.0
+    if monitor is None:
+      monitor = ReplayMonitor(deadlines=DeadlineScheduler(clock=lambda: self._now))
+    self.monitor = monitor
+    self.counts = collections.Counter()
+
+  def _setRelay(self, on):
+    self.counts['relay_on' if on else 'relay_off'] += 1
+
+  def _controllerChanged(self, state, temperature, timestamp):
+    self.counts['controller_changes'] += 1
+
+  def replay(self, records):
+    start_time = time.time()
+    first_timestamp = None
+    for timestamp, kind, payload in records:
+      if self._speed > 0:
+        if first_timestamp is None:
+          first_timestamp = timestamp
+        delay = (timestamp - first_timestamp)/self._speed - (time.time() - start_time)
+        if delay > 0:
+          time.sleep(delay)
+
+      self._now = timestamp
+      self.monitor.deadlines.runDue()
+      self.counts['records'] += 1
+      if kind == CPX_FRAME:
+        self.i2c.frame = bytearray(payload)
+        if not self.controller.sample(self.cpx):
+          self.counts['invalid_frames'] += 1
+      elif kind == GPIO_EDGE:
+        self.side_door_state = 'Open' if payload == b'\x01' else 'Closed'
+      elif kind == SHADOW:
+        topic, message = splitShadow(payload)
+        message = ReplayMessage(topic, message)
+        if '/shadow/get/' in topic:
+          self.monitor.getCallback(None, None, message)
+        elif '/shadow/update/' in topic:
+          self.monitor.updateCallback(None, None, message)
+      else:
+        self.counts['unknown_records'] += 1
+
+    elapsed = time.time() - start_time
+    summary = dict(self.counts)
+    summary['elapsed'] = elapsed
+    summary['records_per_second'] = self.counts['records']/elapsed if elapsed > 0 else 0.0
+    summary['controller_state'] = self.controller.state
+    summary['monitor_state'] = str(self.monitor.state)
+    summary['emails'] = getattr(self.monitor, 'email_count', 0)
+    summary['auto_closes'] = getattr(self.monitor, 'activation_count', 0)
+    return summary
+
+def validateFrames(records):
+  '''
+  Checks every captured CPX frame in one pass without running the
+  controller. Returns a summary dict.
+  '''
+  buffer = bytearray()
+  short_frames = 0
+  for timestamp, kind, payload in records:
+    if kind != CPX_FRAME:
+      continue
+    if len(payload) != FRAME_SIZE:
+      short_frames += 1
+      continue
+    buffer += payload
+
+  valid, states, temperatures = decodeFrames(buffer)
+  valid_temperatures = [t for t, ok in zip(temperatures, valid) if ok]
+  summary = {
+    'frames': len(valid) + short_frames,
+    'valid_frames': int(sum(valid)),
+    'invalid_frames': len(valid) - int(sum(valid)) + short_frames
+  }
+  if valid_temperatures:
+    summary['min_temperature'] = min(valid_temperatures)
+    summary['max_temperature'] = max(valid_temperatures)
+  return summary
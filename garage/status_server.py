@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import threading
+
+import websockets
+
+from garage.protocol import ACTIVATE_COMMAND, encodeStatus
+
+logging.basicConfig(format='%(asctime)-15s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+class StatusServer(threading.Thread):
+  '''
+  Pushes every new controller sample to connected WebSocket clients as a
+  binary frame (see garage.protocol) and accepts activation commands on the
+  same connection.
+  '''
+  def __init__(self, controller, host='0.0.0.0', port=5001):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self._controller = controller
+    self._host = host
+    self._port = port
+    self._clients = set()
+    self._loop = None
+    self._server = None
+    controller.addListener(self.publish)
+
+  def publish(self, state, temperature, timestamp):
+    # Called from the controller thread.
+    if self._loop is None or len(self._clients) == 0:
+      return
+    frame = encodeStatus(state, temperature, timestamp)
+    self._loop.call_soon_threadsafe(self._broadcast, frame)
+
+  def _broadcast(self, frame):
+    for client in list(self._clients):
+      asyncio.ensure_future(self._send(client, frame))
+
+  async def _send(self, client, frame):
+    try:
+      await client.send(frame)
+    except websockets.ConnectionClosed:
+      self._clients.discard(client)
+
+  async def _handle(self, websocket, path=None):
+    logger.info('WebSocket client connected')
+    self._clients.add(websocket)
+    try:
+      await websocket.send(encodeStatus(self._controller.state_code,
+                                        self._controller.temperature,
+                                        self._controller.sample_time))
+      async for message in websocket:
+        if isinstance(message, bytes) and len(message) > 0 and\
+           message[0] == ACTIVATE_COMMAND:
+          logger.info('Activation requested over WebSocket')
+          self._controller.remotely_activated = True
+    except websockets.ConnectionClosed:
+      pass
+    finally:
+      self._clients.discard(websocket)
+      logger.info('WebSocket client disconnected')
+
+  async def _serve(self):
+    return await websockets.serve(self._handle, self._host, self._port)
+
+  async def serve(self):
+    '''Serves on the running event loop instead of a thread of its own.'''
+    self._loop = asyncio.get_event_loop()
+    self._server = await self._serve()
+    logger.info('Serving status WebSocket on {}:{}'.format(self._host, self._port))
+
+  def close(self):
+    if self._server is not None:
+      self._server.close()
+
+  def run(self):
+    self._loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self._loop)
+    self._server = self._loop.run_until_complete(self._serve())
+    logger.info('Serving status WebSocket on {}:{}'.format(self._host, self._port))
+    self._loop.run_forever()
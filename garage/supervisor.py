@@ -0,0 +1,92 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import signal
+import time
+
+logging.basicConfig(format='%(asctime)-15s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+Component = collections.namedtuple('Component', ['name', 'run', 'stop'])
+
+class Supervisor(object):
+  '''
+  Runs blocking components (each a run() that loops until stop() is called)
+  on worker threads of one asyncio event loop, restarting any that return
+  or raise with exponential backoff. Coroutines such as the WebSocket status
+  server can be hosted on the same loop.
+  '''
+  RESTART_DELAY = 1.0
+  MAX_RESTART_DELAY = 60.0
+  STABLE_TIME = 60.0
+
+  def __init__(self):
+    self._components = []
+    self._coroutines = []
+    self._running = False
+    self._loop = None
+    self._stopped = None
+    self.restart_counts = collections.Counter()
+
+  def add(self, name, run, stop=None):
+    self._components.append(Component(name, run, stop))
+
+  def addCoroutine(self, coroutine):
+    self._coroutines.append(coroutine)
+
+  async def _supervise(self, executor, component):
+    delay = Supervisor.RESTART_DELAY
+    while self._running:
+      start_time = time.time()
+      logger.info('Starting {}'.format(component.name))
+      try:
+        await self._loop.run_in_executor(executor, component.run)
+        if self._running:
+          logger.error('{} exited unexpectedly'.format(component.name))
+      except Exception as e:
+        logger.error('{} failed: {}'.format(component.name, e))
+      if not self._running:
+        break
+
+      self.restart_counts[component.name] += 1
+      if time.time() - start_time > Supervisor.STABLE_TIME:
+        delay = Supervisor.RESTART_DELAY
+      logger.info('Restarting {} in {} seconds'.format(component.name, delay))
+      try:
+        await asyncio.wait_for(self._stopped.wait(), delay)
+      except asyncio.TimeoutError:
+        pass
+      delay = min(Supervisor.MAX_RESTART_DELAY, delay*2)
+
+  def stop(self):
+    if not self._running:
+      return
+    logger.info('Stopping all components...')
+    self._running = False
+    self._stopped.set()
+    for component in self._components:
+      if component.stop is not None:
+        try:
+          component.stop()
+        except Exception as e:
+          logger.error('Failed to stop {}: {}'.format(component.name, e))
+
+  def run(self):
+    self._loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self._loop)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+      self._loop.add_signal_handler(signum, self.stop)
+
+    self._stopped = asyncio.Event()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self._components))
+    self._running = True
+    try:
+      for coroutine in self._coroutines:
+        self._loop.run_until_complete(coroutine)
+      self._loop.run_until_complete(asyncio.gather(
+        *[self._supervise(executor, component) for component in self._components]))
+    finally:
+      executor.shutdown(wait=True)
+      self._loop.close()
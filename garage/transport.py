@@ -0,0 +1,151 @@
+import collections
+import logging
+import threading
+
+logging.basicConfig(format='%(asctime)-15s %(message)s')
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Topics used between the connector and the monitor on the LAN.
+def stateTopic(thing_name):
+  return 'garage/{}/state'.format(thing_name)
+
+def activateTopic(thing_name):
+  return 'garage/{}/activate'.format(thing_name)
+
+Message = collections.namedtuple('Message', ['topic', 'payload'])
+
+def topicMatches(pattern, topic):
+  pattern_levels = pattern.split('/')
+  topic_levels = topic.split('/')
+  for index, level in enumerate(pattern_levels):
+    if level == '#':
+      return True
+    if index >= len(topic_levels):
+      return False
+    if level != '+' and level != topic_levels[index]:
+      return False
+  return len(pattern_levels) == len(topic_levels)
+
+class LocalBroker(object):
+  '''
+  In-process stand-in for a LAN MQTT broker. Messages are delivered
+  synchronously on the publishing thread, to exact topic subscriptions
+  first and then to wildcard ones.
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._exact = collections.defaultdict(list)
+    self._wildcards = []
+    self.message_count = 0
+
+  def client(self, client_id=''):
+    return LocalBrokerClient(self, client_id)
+
+  def subscribe(self, client, topic, callback):
+    with self._lock:
+      if '+' in topic or '#' in topic:
+        self._wildcards.append((topic, client, callback))
+      else:
+        self._exact[topic].append((topic, client, callback))
+
+  def publish(self, topic, payload):
+    if isinstance(payload, str):
+      payload = payload.encode('utf-8')
+    with self._lock:
+      subscriptions = self._exact.get(topic, []) + self._wildcards
+      self.message_count += 1
+    message = Message(topic, payload)
+    for pattern, client, callback in subscriptions:
+      if client.connected and topicMatches(pattern, topic):
+        callback(client, None, message)
+
+class LocalBrokerClient(object):
+  '''LocalBroker client with the subset of the AWSIoTMQTTClient API we use.'''
+  def __init__(self, broker, client_id=''):
+    self._broker = broker
+    self.client_id = client_id
+    self.connected = False
+
+  def connect(self):
+    self.connected = True
+
+  def disconnect(self):
+    self.connected = False
+
+  def subscribe(self, topic, qos, callback):
+    self._broker.subscribe(self, topic, callback)
+
+  def publish(self, topic, payload, qos):
+    if not self.connected:
+      raise IOError('Not connected to the local broker')
+    self._broker.publish(topic, payload)
+
+class MQTTClient(object):
+  '''
+  paho-mqtt client for a broker on the LAN (e.g. mosquitto), wrapped in the
+  subset of the AWSIoTMQTTClient API we use. The network loop keeps
+  retrying the broker, so one that is down at startup is picked up once it
+  comes back; publishing while disconnected raises instead of queueing.
+  '''
+  RECONNECT_MIN_DELAY = 1
+  RECONNECT_MAX_DELAY = 60
+
+  def __init__(self, host, port=1883, client_id='', keepalive=60):
+    import paho.mqtt.client as mqtt
+    self._mqtt = mqtt
+    try:
+      self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id)
+    except AttributeError:
+      self._client = mqtt.Client(client_id)
+    self._client.on_connect = self._onConnect
+    self._client.on_disconnect = self._onDisconnect
+    self._client.reconnect_delay_set(MQTTClient.RECONNECT_MIN_DELAY,
+                                     MQTTClient.RECONNECT_MAX_DELAY)
+    self.connected = False
+    self._host = host
+    self._port = port
+    self._keepalive = keepalive
+    self._subscriptions = []
+
+  @classmethod
+  def fromAddress(cls, address, client_id=''):
+    '''Creates a client for a "host" or "host:port" address.'''
+    host, _, port = address.partition(':')
+    return cls(host, int(port) if port else 1883, client_id)
+
+  def _onConnect(self, client, userdata, flags, rc):
+    if rc != 0:
+      logger.warning('Local broker refused the connection: %s', rc)
+      return
+    self.connected = True
+    # (Re)subscribe on every connection; the broker may not keep sessions.
+    for topic, qos in self._subscriptions:
+      client.subscribe(topic, qos)
+
+  def _onDisconnect(self, client, userdata, rc):
+    self.connected = False
+
+  def connect(self):
+    self._client.connect_async(self._host, self._port, self._keepalive)
+    self._client.loop_start()
+
+  def disconnect(self):
+    self._client.disconnect()
+    self._client.loop_stop()
+    self.connected = False
+
+  def subscribe(self, topic, qos, callback):
+    self._client.message_callback_add(topic, callback)
+    self._subscriptions.append((topic, qos))
+    self._client.subscribe(topic, qos)
+
+  def publish(self, topic, payload, qos):
+    # paho would queue a QoS 1 message until the next connection; a late
+    # activation would toggle the door after the caller fell back to HTTP.
+    if not self.connected:
+      raise IOError('Not connected to the local broker')
+    info = self._client.publish(topic, payload, qos)
+    if info.rc != self._mqtt.MQTT_ERR_SUCCESS:
+      raise IOError('Failed to publish to {}: {}'.format(
+        topic, self._mqtt.error_string(info.rc)))
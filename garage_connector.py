@@ -1,14 +1,40 @@
 #!/usr/bin/env python
 
+import argparse
 import logging
+import signal
+import sys
 
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+from garage.capture import CaptureWriter
 from garage.connector import GarageConnector
+from garage.logs import setupLogging
+from garage.transport import MQTTClient
 
 logging.basicConfig(format='%(asctime)-15s %(message)s')
 
+def parseArguments():
+  parser = argparse.ArgumentParser(description='Garage door AWS IoT connector')
+  parser.add_argument('--capture', metavar='PATH',
+                      help='record side door edges and shadow messages to a capture file')
+  parser.add_argument('--local-broker', metavar='HOST[:PORT]',
+                      help='also publish to and take commands from a LAN MQTT broker')
+  parser.add_argument('--log-file', metavar='PATH',
+                      help='write logs to a size-rotated file instead of the console')
+  return parser.parse_args()
+
 if __name__ == '__main__':
+  # Turn SIGTERM into a normal exit so the capture file is flushed.
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
   logger = logging.getLogger(__name__)
   logger.setLevel(logging.INFO)
-  garage_connector = GarageConnector()
+  args = parseArguments()
+  setupLogging(args.log_file)
+  recorder = None
+  if args.capture:
+    recorder = CaptureWriter(args.capture)
+  local_transport = None
+  if args.local_broker:
+    local_transport = MQTTClient.fromAddress(args.local_broker, 'GarageConnector')
+  garage_connector = GarageConnector(recorder=recorder, local_transport=local_transport)
   garage_connector.run()
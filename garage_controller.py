@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 
+import argparse
 import logging
+import signal
+import sys
 
 import flask
 
+from garage.capture import CaptureWriter
 from garage.controller import GarageController
+from garage.logs import ringBuffer, setupLogging
+from garage.protocol import encodeStatus
+from garage.status_server import StatusServer
 
 logging.basicConfig(format='%(asctime)-15s %(message)s')
 logger = logging.getLogger(__name__)
@@ -25,13 +32,74 @@ def summary():
 def data():
   return flask.jsonify(state=garage_controller.state, temperature=garage_controller.temperature)
 
+@app.route('/stats/', methods=['GET'])
+def stats():
+  return flask.jsonify(**garage_controller.stats)
+
+@app.route('/logs/', methods=['GET'])
+def logs():
+  try:
+    records = ringBuffer().records(flask.request.args.get('level', 'DEBUG'),
+                                   flask.request.args.get('limit', type=int))
+  except ValueError:
+    flask.abort(400)
+  return flask.jsonify(records=records)
+
+@app.route('/binary/', methods=['GET'])
+def binaryData():
+  return flask.Response(
+    encodeStatus(garage_controller.state_code, garage_controller.temperature,
+                 garage_controller.sample_time),
+    mimetype='application/octet-stream')
+
 @app.route('/activate/', methods=['PUT'])
 def activate():
   garage_controller.remotely_activated = True
   return 'OK'
 
+def createServer(host='0.0.0.0', port=5000, threads=4):
+  # waitress is a small pure-Python threaded WSGI server with HTTP/1.1
+  # keep-alive, so pollers can reuse their connections.
+  import waitress
+  logger.info('Serving on {}:{} with waitress ({} threads)'.format(host, port, threads))
+  return waitress.create_server(app, host=host, port=port, threads=threads)
+
+def serve(host='0.0.0.0', port=5000, production=False, debug=False, threads=4):
+  if production:
+    createServer(host, port, threads).run()
+  else:
+    app.debug = debug
+    app.run(host=host, port=port, use_reloader=False, threaded=True)
+
+def parseArguments():
+  parser = argparse.ArgumentParser(description='Garage door controller')
+  parser.add_argument('--host', default='0.0.0.0')
+  parser.add_argument('--port', type=int, default=5000)
+  parser.add_argument('--production', action='store_true',
+                      help='serve with the threaded waitress WSGI server')
+  parser.add_argument('--threads', type=int, default=4,
+                      help='number of request threads in production mode')
+  parser.add_argument('--websocket-port', type=int, default=5001,
+                      help='port for the binary status WebSocket (0 disables it)')
+  parser.add_argument('--capture', metavar='PATH',
+                      help='record raw CPX frames to a capture file')
+  parser.add_argument('--log-file', metavar='PATH',
+                      help='write logs to a size-rotated file instead of the console')
+  parser.add_argument('--debug', action='store_true',
+                      help='enable the Flask debugger (development server only)')
+  return parser.parse_args()
+
 if __name__ == '__main__':
+  # Turn SIGTERM into a normal exit so the capture file is flushed.
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  args = parseArguments()
+  setupLogging(args.log_file)
+  if args.capture:
+    garage_controller.recorder = CaptureWriter(args.capture)
   garage_controller.setDaemon(True)
   garage_controller.start()
-  app.debug = True
-  app.run(host = '0.0.0.0', port = 5000, use_reloader=False)
+  if args.websocket_port:
+    status_server = StatusServer(garage_controller, args.host, args.websocket_port)
+    status_server.start()
+  serve(args.host, args.port, production=args.production, debug=args.debug,
+        threads=args.threads)
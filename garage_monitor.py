@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 
+import argparse
 import logging
+import signal
+import sys
 import time
 
 import flask
 
-from garage.monitor import GarageMonitor, GarageState
+from garage.capture import CaptureWriter
+from garage.logs import ringBuffer, setupLogging
+from garage.monitor import GarageMonitor
+from garage.persistence import WriteBehindWriter
 
 logging.basicConfig(format='%(asctime)-15s %(message)s')
 
@@ -15,20 +21,69 @@ app = flask.Flask(__name__)
 @app.route('/')
 @app.route('/status/')
 def displayStatus():
+    if garage_monitor.shadow is None:
+      return 'Waiting for the first garage door report', 503
     return flask.render_template('status.html', shadow=garage_monitor.shadow)
 
+@app.route('/deadlines/')
+def listDeadlines():
+  now = time.time()
+  deadlines = {}
+  for key, deadline in garage_monitor.deadlines.pending.items():
+    deadlines[key] = {'deadline': deadline, 'remaining': deadline - now}
+  return flask.jsonify(deadlines)
+
+@app.route('/stats/')
+def stats():
+  return flask.jsonify(garage_monitor.stats)
+
+@app.route('/logs/')
+def logs():
+  try:
+    records = ringBuffer().records(flask.request.args.get('level', 'DEBUG'),
+                                   flask.request.args.get('limit', type=int))
+  except ValueError:
+    flask.abort(400)
+  return flask.jsonify(records=records)
+
+def parseArguments():
+  parser = argparse.ArgumentParser(description='Garage door monitor')
+  parser.add_argument('--capture', metavar='PATH',
+                      help='record inbound shadow messages to a capture file')
+  parser.add_argument('--fsync-interval', type=float,
+                      default=WriteBehindWriter.FSYNC_INTERVAL,
+                      help='seconds between fsyncs of the event database')
+  parser.add_argument('--snapshot', metavar='PATH', default='monitor_snapshot.json',
+                      help='file the monitor state is saved to and restored from')
+  parser.add_argument('--log-file', metavar='PATH',
+                      help='write logs to a size-rotated file instead of the console')
+  return parser.parse_args()
+
 def main():
+  args = parseArguments()
+  setupLogging(args.log_file)
+  garage_monitor.writer.fsync_interval = args.fsync_interval
+  garage_monitor.snapshot_path = args.snapshot
+  if args.capture:
+    garage_monitor.recorder = CaptureWriter(args.capture)
   logger = logging.getLogger(__name__)
   logger.setLevel(logging.DEBUG)
+  # Serve from the restored state right away. connect() only starts the
+  # AWS connection in the background; the shadow get it sends reconciles
+  # the restored state and arms any auto-close deadline.
+  garage_monitor.restore()
   logger.debug('Before connect')
   garage_monitor.connect()
   logger.debug('After connect')
-  while(garage_monitor.state == GarageState.UNKNOWN):
-    time.sleep(1)
 
   #app.secret_key = 'super_secret_key'
   app.debug = True
-  app.run(host = '0.0.0.0', port = 5000, use_reloader=False)
+  try:
+    app.run(host = '0.0.0.0', port = 5000, use_reloader=False)
+  finally:
+    garage_monitor.close()
 
 if __name__ == '__main__':
+  # Turn SIGTERM into a normal exit so queued events are flushed.
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
   main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+
+from garage.capture import CaptureWriter
+from garage.connector import GarageConnector, LocalControllerSource
+from garage.logs import setupLogging
+from garage.status_server import StatusServer
+from garage.supervisor import Supervisor
+from garage.transport import MQTTClient
+import garage_controller
+
+logging.basicConfig(format='%(asctime)-15s %(message)s')
+
+class HTTPServer(object):
+  '''Creates a fresh waitress server on every (re)start.'''
+  def __init__(self, host, port, threads):
+    self._host = host
+    self._port = port
+    self._threads = threads
+    self._server = None
+
+  def run(self):
+    self._server = garage_controller.createServer(self._host, self._port, self._threads)
+    self._server.run()
+
+  def stop(self):
+    if self._server is not None:
+      self._server.close()
+
+def parseArguments():
+  parser = argparse.ArgumentParser(
+    description='Run the garage controller, its HTTP API and the AWS IoT connector in one process')
+  parser.add_argument('--host', default='0.0.0.0')
+  parser.add_argument('--port', type=int, default=5000)
+  parser.add_argument('--threads', type=int, default=4,
+                      help='number of HTTP request threads')
+  parser.add_argument('--websocket-port', type=int, default=5001,
+                      help='port for the binary status WebSocket (0 disables it)')
+  parser.add_argument('--local-broker', metavar='HOST[:PORT]',
+                      help='also publish to and take commands from a LAN MQTT broker')
+  parser.add_argument('--capture', metavar='PATH',
+                      help='record CPX frames, side door edges and shadow messages')
+  parser.add_argument('--log-file', metavar='PATH',
+                      help='write logs to a size-rotated file instead of the console')
+  return parser.parse_args()
+
+def main():
+  args = parseArguments()
+  setupLogging(args.log_file)
+
+  controller = garage_controller.garage_controller
+  recorder = None
+  if args.capture:
+    recorder = CaptureWriter(args.capture)
+    controller.recorder = recorder
+
+  local_transport = None
+  if args.local_broker:
+    local_transport = MQTTClient.fromAddress(args.local_broker, 'GarageConnector')
+  connector = GarageConnector(recorder=recorder, local_transport=local_transport,
+                              source=LocalControllerSource(controller))
+  server = HTTPServer(args.host, args.port, args.threads)
+
+  supervisor = Supervisor()
+  supervisor.add('controller', controller.run, controller.stop)
+  supervisor.add('http', server.run, server.stop)
+  supervisor.add('connector', connector.run, connector.stop)
+  if args.websocket_port:
+    status_server = StatusServer(controller, args.host, args.websocket_port)
+    supervisor.addCoroutine(status_server.serve())
+  supervisor.run()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+
+from garage.capture import mergeCaptures
+from garage.replay import Replayer, validateFrames
+
+logging.basicConfig(format='%(asctime)-15s %(message)s')
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Replay capture files through the controller and monitor')
+  parser.add_argument('captures', nargs='+', help='capture files to merge and replay')
+  parser.add_argument('--speed', type=float, default=0.0,
+                      help='replay speed multiplier (1 is real time, 0 is as fast as possible)')
+  parser.add_argument('--validate', action='store_true',
+                      help='only check the captured CPX frames')
+  args = parser.parse_args()
+
+  if args.validate:
+    summary = validateFrames(mergeCaptures(args.captures))
+  else:
+    replayer = Replayer(speed=args.speed)
+    summary = replayer.replay(mergeCaptures(args.captures))
+  for key in sorted(summary.keys()):
+    print('{:20} {}'.format(key, summary[key]))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,140 @@
+'''
+Checks the frame codec against a line-by-line transliteration of the
+CPX.ino firmware, which is what actually writes the frames on the bus.
+'''
+
+import os
+import random
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from garage import frames
+
+def firmwareFletcher16(data):
+  # uint16_t fletcher16(uint8_t *data, int count) in CPX.ino
+  sum1 = 0
+  sum2 = 0
+  for byte in data:
+    sum1 = ((sum1 + byte) % 255) & 0xffff
+    sum2 = ((sum2 + sum1) % 255) & 0xffff
+  return ((sum2 << 8) | sum1) & 0xffff
+
+def firmwareRound(value):
+  # Arduino's round() rounds halves away from zero.
+  return int(value + 0.5) if value >= 0 else int(value - 0.5)
+
+def firmwareFrame(state, temperature):
+  # The send_buffer fill at the end of loop() in CPX.ino.
+  temp = firmwareRound(temperature*100)
+  send_buffer = bytearray()
+  send_buffer.append(state & 0xff)
+  send_buffer.append(temp & 0xff)
+  send_buffer.append((temp >> 8) & 0xff)
+  send_buffer.append((temp >> 16) & 0xff)
+  send_buffer.append((temp >> 24) & 0xff)
+  checksum = firmwareFletcher16(send_buffer)
+  send_buffer.append(checksum & 0xff)
+  send_buffer.append((checksum >> 8) & 0xff)
+  return bytes(send_buffer)
+
+def referenceDecode(frame):
+  checksum = frame[5] | (frame[6] << 8)
+  state = frame[0]
+  if checksum != firmwareFletcher16(frame[:5]):
+    return None
+  if state < frames.MIN_STATE or state > frames.MAX_STATE:
+    return None
+  return (state, struct.unpack('<i', bytes(frame[1:5]))[0]/100.0)
+
+def randomTemperature(rng):
+  return round(rng.uniform(-40.0, 125.0), rng.choice([0, 1, 2, 3]))
+
+def sampleFrames(seed=0, count=2000):
+  '''Encoded frames, their single-bit corruptions and random bytes.'''
+  rng = random.Random(seed)
+  samples = []
+  for index in range(count):
+    frame = frames.encodeFrame(rng.randrange(256), randomTemperature(rng))
+    samples.append(frame)
+    corrupted = bytearray(frame)
+    corrupted[rng.randrange(frames.FRAME_SIZE)] ^= 1 << rng.randrange(8)
+    samples.append(bytes(corrupted))
+    samples.append(bytes(rng.randrange(256) for byte in range(frames.FRAME_SIZE)))
+  samples.append(b'\x00'*frames.FRAME_SIZE)
+  samples.append(b'\xff'*frames.FRAME_SIZE)
+  return samples
+
+def test_fletcher16_matches_firmware():
+  rng = random.Random(1)
+  for count in range(64):
+    data = bytes(rng.randrange(256) for byte in range(count))
+    assert frames.fletcher16(data) == firmwareFletcher16(data)
+  for data in (b'', b'\xff'*frames.DATA_SIZE, b'\xff'*1024, b'\x00'*1024):
+    assert frames.fletcher16(data) == firmwareFletcher16(data)
+
+def test_encodeFrame_matches_firmware():
+  rng = random.Random(2)
+  for index in range(2000):
+    state = rng.randrange(256)
+    temperature = randomTemperature(rng)
+    assert frames.encodeFrame(state, temperature) == firmwareFrame(state, temperature)
+  for temperature in (0.005, -0.005, 0.015, -0.015, 21.125, -21.125):
+    assert frames.encodeFrame(3, temperature) == firmwareFrame(3, temperature)
+
+def test_decodeFrame_matches_firmware():
+  for frame in sampleFrames():
+    assert frames.decodeFrame(frame) == referenceDecode(frame)
+    assert frames.decodeFrame(bytearray(frame)) == referenceDecode(frame)
+
+def test_decodeFrame_round_trip():
+  rng = random.Random(3)
+  for state in range(frames.MIN_STATE, frames.MAX_STATE + 1):
+    temperature = firmwareRound(rng.uniform(-40.0, 125.0)*100)/100.0
+    assert frames.decodeFrame(firmwareFrame(state, temperature)) == (state, temperature)
+
+def test_decodeFrame_rejects_short_frames():
+  frame = firmwareFrame(3, 20.0)
+  for size in range(frames.FRAME_SIZE):
+    assert frames.decodeFrame(frame[:size]) is None
+
+def expectedBatch(samples):
+  valid = []
+  states = []
+  temperatures = []
+  for frame in samples:
+    decoded = referenceDecode(frame)
+    valid.append(decoded is not None)
+    states.append(frame[0])
+    temperatures.append(struct.unpack('<i', frame[1:5])[0]/100.0)
+  return (valid, states, temperatures)
+
+def test_decodeFramesPython_matches_firmware():
+  samples = sampleFrames(seed=4)
+  valid, states, temperatures = frames._decodeFramesPython(bytearray(b''.join(samples)))
+  assert (valid, states, temperatures) == expectedBatch(samples)
+
+@pytest.mark.skipif(frames.numpy is None, reason='NumPy is not installed')
+def test_decodeFrames_numpy_matches_firmware():
+  samples = sampleFrames(seed=5)
+  valid, states, temperatures = frames.decodeFrames(bytearray(b''.join(samples)))
+  assert (valid.tolist(), states.tolist(), temperatures.tolist()) == expectedBatch(samples)
+
+def test_decodeFrames_without_numpy(monkeypatch):
+  monkeypatch.setattr(frames, 'numpy', None)
+  samples = sampleFrames(seed=6, count=200)
+  assert frames.decodeFrames(b''.join(samples)) == expectedBatch(samples)
+
+def test_decodeFrames_empty_buffer():
+  valid, states, temperatures = frames.decodeFrames(b'')
+  assert len(valid) == len(states) == len(temperatures) == 0
+
+@pytest.mark.parametrize('with_numpy', [True, False])
+def test_decodeFrames_rejects_partial_frames(monkeypatch, with_numpy):
+  if not with_numpy:
+    monkeypatch.setattr(frames, 'numpy', None)
+  with pytest.raises(ValueError):
+    frames.decodeFrames(b'\x00'*(frames.FRAME_SIZE + 1))
@@ -0,0 +1,123 @@
+'''
+Checks how a restored GarageMonitor arms its auto-close deadline once the
+first report after a restart arrives.
+'''
+
+from datetime import datetime, timezone
+import json
+import os
+import sys
+import time
+
+import pytest
+from tinydb import TinyDB
+from tinydb.storages import MemoryStorage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from garage.deadlines import DeadlineScheduler
+from garage.monitor import GarageMonitor, GarageState
+from garage.persistence import WriteBehindWriter
+
+DAY = 24*60*60
+
+def report(report_time, version, state='FullyOpen', state_update=False):
+  timestamp = datetime.fromtimestamp(report_time, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+  return {'version': version,
+          'state': {'reported': {'Timestamp': timestamp, 'State': state,
+                                 'SideDoorState': 'Closed', 'StateUpdate': state_update,
+                                 'Temperature': 20.0}}}
+
+class RecordingMonitor(GarageMonitor):
+  def __init__(self, **kwargs):
+    GarageMonitor.__init__(self, **kwargs)
+    self.activations = 0
+
+  def sendEmail(self, shadow, init=False):
+    pass
+
+  def activateDoor(self):
+    self.activations += 1
+
+@pytest.fixture
+def restored(tmp_path):
+  '''A monitor restored with the door left open since a day ago, at version 10.'''
+  opened = report(time.time() - DAY, 10)
+  snapshot_path = str(tmp_path/'snapshot.json')
+  with open(snapshot_path, 'w') as snapshot_file:
+    json.dump({'state': 'OPEN', 'history': [opened], 'shadow': opened, 'version': 10,
+               'saved': time.time()}, snapshot_file)
+  db = TinyDB(storage=MemoryStorage)
+  monitor = RecordingMonitor(db=db, writer=WriteBehindWriter(db),
+                             deadlines=DeadlineScheduler(), snapshot_path=snapshot_path)
+  assert monitor.restore()
+  assert monitor.state == GarageState.OPEN
+  yield monitor
+  monitor.close()
+
+def test_restore_does_not_arm(restored):
+  assert restored.deadlines.deadline(restored.thing_name) is None
+  restored.deadlines.runDue()
+  assert restored.activations == 0
+
+def test_up_to_date_get_confirms_restored_history(restored):
+  restored.reconcile(report(time.time() - DAY, 10))
+  assert restored.deadlines.deadline(restored.thing_name) ==\
+    GarageMonitor.reportTime(restored.history[0]) + restored.timeout_duration
+  restored.deadlines.runDue()
+  assert restored.activations == 1
+
+def test_contiguous_report_confirms_restored_history(restored):
+  opened_time = GarageMonitor.reportTime(restored.history[0])
+  restored.reconcile(report(time.time() - 30, 11))
+  assert restored.deadlines.deadline(restored.thing_name) ==\
+    opened_time + restored.timeout_duration
+  restored.deadlines.runDue()
+  assert restored.activations == 1
+
+def test_missed_reports_drop_restored_history(restored):
+  reopened = report(time.time() - 30, 17)
+  restored.reconcile(reopened)
+  assert len(restored.history) == 1
+  assert restored.deadlines.deadline(restored.thing_name) ==\
+    GarageMonitor.reportTime(reopened) + restored.timeout_duration
+  restored.deadlines.runDue()
+  assert restored.activations == 0
+
+def test_state_change_drops_restored_history(restored):
+  reopened = report(time.time() - 30, 11, state_update=True)
+  restored.handleUpdate(reopened)
+  assert restored.deadlines.deadline(restored.thing_name) ==\
+    GarageMonitor.reportTime(reopened) + restored.timeout_duration
+  restored.deadlines.runDue()
+  assert restored.activations == 0
+
+def test_unversioned_local_report_drops_restored_history(restored):
+  local = report(time.time() - 30, None)
+  del local['version']
+  restored.handleUpdate(local)
+  assert restored.deadlines.deadline(restored.thing_name) ==\
+    GarageMonitor.reportTime(local) + restored.timeout_duration
+  restored.deadlines.runDue()
+  assert restored.activations == 0
+
+def readSnapshot(monitor):
+  with open(monitor.snapshot_path) as snapshot_file:
+    return json.load(snapshot_file)
+
+def test_snapshot_is_written_off_the_callback(restored):
+  restored.handleUpdate(report(time.time(), 11, 'Closed', state_update=True))
+  assert readSnapshot(restored)['version'] == 10
+  restored.deadlines.runDue()
+  snapshot = readSnapshot(restored)
+  assert snapshot['version'] == 11
+  assert snapshot['state'] == 'CLOSED'
+
+def test_close_writes_the_snapshot_and_flushes_events(restored):
+  restored.handleUpdate(report(time.time(), 11, 'Closed', state_update=True))
+  restored.close()
+  assert readSnapshot(restored)['version'] == 11
+  assert len(restored._db.all()) == 1
+  # A queued older snapshot must not overwrite the one close() wrote.
+  restored.deadlines.runDue()
+  assert readSnapshot(restored)['version'] == 11